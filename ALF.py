@@ -6,15 +6,20 @@ Created on Wed Feb 7 13:35:66 2017
 @author: ankur
 """
 import os, sys
+import copy
 import cv2
 import numpy as np
 import imageio
 import time
+import queue
+import threading
 
 import Car
+import Telemetry
 import BinaryThreshold as BT
 import CameraCalibration as CC
 import utilities as laneUtils
+import Diagnostics as Diag
 
 #tuple(X,Y) containing binary image
 bin_img_shape = (640, 240)
@@ -23,6 +28,9 @@ lane_config = {}
 lane_config['bin_image_shape'] = bin_img_shape
 #lane_config['tracking_memory'] = 5##Harder challenge
 lane_config['tracking_memory'] = 25#20
+#How recent fits are averaged: 'mean', 'confidence' (weighted by lane pixel count) or 'ewma'
+lane_config['fit_averaging'] = 'mean'
+lane_config['ewma_alpha'] = 0.2
 lane_config['scale_X'] = 3.7/420 #(meters/pixels)
 lane_config['scale_Y'] = 3.048/33 #(meters/pixels)
 
@@ -39,6 +47,30 @@ lane_config['max_lane_width'] = 520
 #lane_config['min_RoC'] = 130##Harder Challenge
 lane_config['min_RoC'] = 90
 
+#ROI crop: x offset from both sides and first row
+lane_config['ROI_x1'] = 175
+lane_config['ROI_y1'] = 450
+#Go straight from the raw frame to bird's eye view with one remap and threshold there
+#minLane/maxLane are then fractions of the bird's eye image, not the ROI
+lane_config['fused_remap'] = False
+#Headless: lanes only compute fits, RoC and offset. No debug images
+lane_config['headless'] = False
+#Record per stage latency (Profiler.StageTimer)
+lane_config['profile'] = False
+#Real time mode: time budget per frame in ms (None: no deadline). When a frame runs out of time
+#the threshold search stops with the last thresholds, the lane update is skipped (the lanes keep
+#their fits) or, if out of time before thresholding, the whole frame is skipped. A skipped lane
+#update counts as a frame without a detection, so tracking still resets after no_track_frames.
+#The ROI is undistorted first and the rest of the output frame after the lane search
+lane_config['deadline_ms'] = None
+
+#What to write per input: 'video' (annotated frames) or 'telemetry' (lane geometry per frame, no rendering)
+output_mode = 'video'
+
+#Diagnostics level (Diag.DEBUG, Diag.INFO, Diag.WARNING or Diag.OFF) and where to write them ('-' is stdout)
+log_level = Diag.OFF
+log_file = '-'
+
 bt_config = {}
 bt_config['R_Range'] = BT.ThresholdRange(140, 250, 5)
 bt_config['V_Range'] = BT.ThresholdRange(140, 240, 5)
@@ -50,6 +82,9 @@ bt_config['bailout'] = 25
 bt_config['minLane'] = 0.015
 #bt_config['maxLane'] = 0.035 ##Harder challenge
 bt_config['maxLane'] = 0.03
+#Also take pixels with a strong x gradient of R (Sobel, scaled to [0, 255]) as lane pixels
+bt_config['gradient'] = False
+bt_config['gradient_thresh'] = 100
 
 warp_config = {}
 warp_config['P1'] = [402, 10]#[385, 0]
@@ -75,6 +110,46 @@ def get_calibration():
         
           
 
+#Threshold, warp and update the lanes of the car for one frame
+#img is the raw frame, roi the undistorted ROI (not used with the fused remap)
+#birds_eye: fused remap of img, done here if None
+#features: (R, V) of the image that gets thresholded, if already computed (process_frames)
+#Returns the lane debug image (None if headless)
+def _find_lanes(img, roi, Car_obj, birds_eye = None, features = None):
+    timer = Car_obj.timer
+    deadline = Car_obj.deadline
+    if deadline.expired():
+        #no time left for this frame, the lanes keep their fits
+        Car_obj.skip_frame()
+        return None
+    if Car_obj.fused_remap:
+        #Bird's eye view straight from the raw frame, threshold it there. No second resample.
+        #DEBUG_OUT
+        if birds_eye is None:
+            t0 = timer.start()
+            bin_x, bin_y = Car_obj.bin_image_shape
+            birds_eye = Car_obj.birds_eye_remap.remap(img, dst=Car_obj.buffers.get('birds_eye', (bin_y, bin_x, 3)))
+            timer.stop('fused_remap', t0)
+        t0 = timer.start()
+        successFlag, bin_img, Car_obj.bt_cfg = BT.binary_threshold(birds_eye, Car_obj.bt_cfg, Car_obj.buffers, features, deadline)
+        timer.stop('threshold', t0)
+        lane_img = Car_obj.get_lanes(successFlag, bin_img, warped=True)
+    else:
+        #Binary threshold image. We will use the values from the previous frameso save the config
+        #DEBUG_OUT
+        t0 = timer.start()
+        successFlag, bin_img, Car_obj.bt_cfg = BT.binary_threshold(roi, Car_obj.bt_cfg, Car_obj.buffers, features, deadline)
+        timer.stop('threshold', t0)
+        
+        #Calculate a good set of lane fits for the image
+        #Update each lane object for filtering and tracking
+        #DEBUG_OUT
+        lane_img = Car_obj.get_lanes(successFlag, bin_img)
+    timer.count('threshold_steps', Car_obj.bt_cfg['steps'])
+    if Car_obj.bt_cfg['deadline_cut']:
+        Car_obj.deadline_stats['threshold_cut'] += 1
+    return lane_img
+
 # Function to process image. All steps of the pipeline are contained in this
 # If debug is True, the output frame consists of diagnostic view
 # if debug is False, the output image is the final output
@@ -82,33 +157,137 @@ def get_calibration():
 # if required we update it and pass it back
 def _process(img, Car_obj, debug = False):
     
+    timer = Car_obj.timer
+    Car_obj.start_frame()
+    
     #undistort image
     #DEBUG_OUT
-    undist_img = laneUtils.undistort(img, Car_obj.cam_calib)
+    #the output frame, so it comes from the 'frame' slots (see process_video)
+    undist_img = Car_obj.buffers.get('frame', img.shape)
+    ROI_x1, ROI_y1 = Car_obj.ROI_x1, Car_obj.ROI_y1
+    #with a deadline only the ROI is undistorted before the lane search, the rest of the frame after it
+    roi_first = Car_obj.deadline.budget is not None
+    t0 = timer.start()
+    if roi_first:
+        Car_obj.undistort_remap.undistort_roi(img, ROI_x1, ROI_y1, dst=laneUtils.get_ROI(undist_img, ROI_x1, ROI_y1))
+    else:
+        Car_obj.undistort_remap.undistort(img, dst=undist_img)
+    timer.stop('undistort', t0)
 
     #crop out ROI
-    ROI_x1, ROI_y1 = 175, 450
+    t0 = timer.start()
     roi = laneUtils.get_ROI(undist_img, ROI_x1, ROI_y1)
+    timer.stop('roi', t0)
   
-    #Binary threshold image. We will use the values from the previous frameso save the config
-    #DEBUG_OUT
-    successFlag, bin_img, Car_obj.bt_cfg = BT.binary_threshold(roi, Car_obj.bt_cfg)
+    lane_img = _find_lanes(img, roi, Car_obj)
     
-    #Calculate a good set of lane fits for the image
-    #Update each lane object for filtering and tracking
-    #DEBUG_OUT
-    lane_img = Car_obj.get_lanes(successFlag, bin_img)
+    if roi_first:
+        t0 = timer.start()
+        Car_obj.undistort_remap.undistort_outside_roi(img, ROI_x1, ROI_y1, undist_img)
+        timer.stop('undistort', t0)
     
     #Draw lanes on the colored image
     #DEBUG_OUT
-    lane_roi, ret = Car_obj.draw_lanes(roi);
-            
-    undist_img = laneUtils.set_ROI(undist_img, ROI_x1, ROI_y1, lane_roi)
+    t0 = timer.start()
+    #roi is a view of undist_img, the lanes are drawn straight into it
+    _, ret = Car_obj.draw_lanes(roi)
+    timer.stop('draw', t0)
     
+    t0 = timer.start()
     undist_img = Car_obj.annotate_image(undist_img, ret)
-        
+    timer.stop('annotate', t0)
+    
+    Car_obj.end_frame()
+    Car_obj.frame_count += 1
     return Car_obj, undist_img
 
+#Headless version of _process: only the lane fits, RoC and offset are updated.
+#Only the ROI is undistorted (or nothing at all with the fused remap) and nothing is drawn
+def _process_headless(img, Car_obj):
+    Car_obj.start_frame()
+    roi = None
+    if not Car_obj.fused_remap:
+        t0 = Car_obj.timer.start()
+        roi_shape = (img.shape[0] - Car_obj.ROI_y1, img.shape[1] - 2*Car_obj.ROI_x1, img.shape[2])
+        roi = Car_obj.undistort_remap.undistort_roi(img, Car_obj.ROI_x1, Car_obj.ROI_y1,
+                                                    dst=Car_obj.buffers.get('roi', roi_shape))
+        Car_obj.timer.stop('undistort', t0)
+    _find_lanes(img, roi, Car_obj)
+    Car_obj.end_frame()
+    Car_obj.frame_count += 1
+    return Car_obj
+
+#Batch version of _process/_process_headless for offline reprocessing.
+#frames: N x H x W x 3 stack of BGR frames, in order.
+#The stateless stages (undistort/ROI or the fused remap, and R/V extraction) run over
+#batch_size frames at a time, the R/V planes of a whole chunk in one pass.
+#The threshold search, warp, Car.update and drawing depend on the previous frame
+#(thresholds, tracked fits), so they then run frame by frame. A frame's deadline
+#(deadline_ms) starts when its stateful stages do, the chunk's shared work is not counted.
+#Returns the Car and the N x H x W x 3 annotated frames (None if the Car is headless)
+def process_frames(frames, Car_obj, batch_size = 16):
+    timer = Car_obj.timer
+    buffers = Car_obj.buffers
+    n, height, width, channels = frames.shape
+    ROI_x1, ROI_y1 = Car_obj.ROI_x1, Car_obj.ROI_y1
+    out_frames = None
+    if not Car_obj.headless:
+        out_frames = np.empty_like(frames)
+    
+    for start in range(0, n, batch_size):
+        chunk = frames[start:start + batch_size]
+        chunk_size = len(chunk)
+        
+        #stateless stages for the whole chunk
+        t0 = timer.start()
+        #the ROIs go in one contiguous block, the rest of the frame straight into the output
+        if not Car_obj.headless:
+            undist_chunk = out_frames[start:start + chunk_size]
+            for i in range(chunk_size):
+                Car_obj.undistort_remap.undistort_outside_roi(chunk[i], ROI_x1, ROI_y1, undist_chunk[i])
+        if not (Car_obj.headless and Car_obj.fused_remap):
+            rois = buffers.get('batch_roi', (chunk_size, height - ROI_y1, width - 2*ROI_x1, channels))
+            for i in range(chunk_size):
+                Car_obj.undistort_remap.undistort_roi(chunk[i], ROI_x1, ROI_y1, dst=rois[i])
+        if Car_obj.fused_remap:
+            bin_x, bin_y = Car_obj.bin_image_shape
+            thresh_imgs = buffers.get('batch_birds_eye', (chunk_size, bin_y, bin_x, channels))
+            for i in range(chunk_size):
+                Car_obj.birds_eye_remap.remap(chunk[i], dst=thresh_imgs[i])
+        else:
+            thresh_imgs = rois
+        R, V = BT.red_and_value_batch(thresh_imgs, buffers)
+        timer.stop('batch_prepare', t0)
+        
+        #stateful stages, in order
+        for i in range(chunk_size):
+            Car_obj.start_frame()
+            if Car_obj.fused_remap:
+                _find_lanes(chunk[i], None, Car_obj, birds_eye = thresh_imgs[i], features = (R[i], V[i]))
+            else:
+                _find_lanes(chunk[i], rois[i], Car_obj, features = (R[i], V[i]))
+            if not Car_obj.headless:
+                t0 = timer.start()
+                _, ret = Car_obj.draw_lanes(rois[i])
+                np.copyto(laneUtils.get_ROI(undist_chunk[i], ROI_x1, ROI_y1), rois[i])
+                timer.stop('draw', t0)
+                t0 = timer.start()
+                Car_obj.annotate_image(undist_chunk[i], ret)
+                timer.stop('annotate', t0)
+            Car_obj.end_frame()
+            Car_obj.frame_count += 1
+    return Car_obj, out_frames
+
+#Print the per stage timing and write it next to the output as CSV and JSON
+def export_timing(Car_obj, file_name):
+    if Car_obj.deadline.budget is not None:
+        print("Deadline {} ms: {}".format(Car_obj.lane_cfg['deadline_ms'], Car_obj.deadline_stats))
+    if not Car_obj.timer.enabled:
+        return
+    Car_obj.timer.print_summary()
+    Car_obj.timer.export_csv(file_name + '_timing.csv')
+    Car_obj.timer.export_json(file_name + '_timing.json')
+
 
 def process_image(image_name, file_name, Car_obj, debug = False):
     image = cv2.imread(image_name)
@@ -116,15 +295,61 @@ def process_image(image_name, file_name, Car_obj, debug = False):
         print("Could not open image")
     print(image.shape)
     
-    out_name =(os.path.splitext(os.path.basename(image_name))[0] + '_out.jpg')
+    out_name = file_name + '_out.jpg'
     
     Car_obj, out_image = _process(image, Car_obj, debug)
     
     cv2.imwrite(out_name, out_image)
     return Car_obj, out_image
 
+#Decode stage of process_video. Runs on its own thread.
+#Puts (frame #, BGR image) on the queue, None when done, or the exception if decoding failed
+#Returns early once stop (threading.Event) is set
+def _decode_frames(in_video, frame_queue, stop):
+    try:
+        for i, image in enumerate(in_video):
+            if stop.is_set():
+                return
+            frame_queue.put((i, cv2.cvtColor(image, cv2.COLOR_RGB2BGR)))
+        frame_queue.put(None)
+    except Exception as e:
+        frame_queue.put(e)
+
+#Stop the decode stage and close the reader, also when the pipeline stopped early.
+#The queue is drained so a decoder blocked on a full queue wakes up and sees stop
+def _stop_decoder(decoder, stop, frame_queue, in_video):
+    stop.set()
+    while decoder.is_alive():
+        try:
+            frame_queue.get(timeout = 0.1)
+        except queue.Empty:
+            pass
+    in_video.close()
+
+#Encode stage of process_video. Runs on its own thread.
+#Takes (frame #, BGR image) off the queue until it gets None
+def _encode_frames(out_video, out_queue, errors):
+    while True:
+        item = out_queue.get()
+        if item is None:
+            break
+        if errors:
+            #keep draining so the pipeline thread never blocks on a full queue
+            continue
+        i, cv_image = item
+        try:
+            cv_image = cv2.putText(cv_image, str(i), (0,30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,255,0), 2)
+            out_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
+            out_video.append_data(out_image)
+            #out_video.append_data(cv_image)
+        except Exception as e:
+            errors.append(e)
+
 #Using imageio because OpenCV and 16.04Ubuntu have some weird issues with avi and mp4
-def process_video(video_name, file_name, Car_obj, debug = False):
+#Decoding, the lane pipeline and encoding run as three stages on their own threads
+#with bounded queues in between (OpenCV and ffmpeg release the GIL). Each stage is a
+#single thread reading a FIFO queue, so frame order is preserved.
+def process_video(video_name, file_name, Car_obj, debug = False, queue_size = 8):
     out_video = None
     in_video = imageio.get_reader(video_name)
     fps = in_video.get_meta_data()['fps']
@@ -133,31 +358,119 @@ def process_video(video_name, file_name, Car_obj, debug = False):
     out_video = imageio.get_writer(out_name, fps = fps)
     #fourcc = cv2.VideoWriter_fourcc(*'XVID')
     #out_video = cv2.VideoWriter('output.avi',fourcc, 20.0, (640,240))
-    for i, image in enumerate(in_video):
-        #if i == 155:
-            #break
-        print()
-        print('Frame # ', i)
-        
-        cv_image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        start = time.time()
-        Car_obj, cv_image = _process(cv_image, Car_obj, debug)
-        end = time.time()
-        dt = (end - start)
-        print("{:.3f} s, {:.2f} FPS".format(dt, 1/dt))
-        cv_image = cv2.putText(cv_image, str(i), (0,30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,255,0), 2)
-        out_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
-        out_video.append_data(out_image)
-        #out_video.append_data(cv_image)
-    out_video.close()
-    #out_video.release()
+    
+    frame_queue = queue.Queue(maxsize = queue_size)
+    out_queue = queue.Queue(maxsize = queue_size)
+    #output frames are pooled, keep enough of them for every frame waiting in
+    #out_queue, the one being encoded and the one being processed
+    Car_obj.buffers.set_slots('frame', queue_size + 2)
+    encode_errors = []
+    stop_decoding = threading.Event()
+    decoder = threading.Thread(target = _decode_frames, args = (in_video, frame_queue, stop_decoding), daemon = True)
+    encoder = threading.Thread(target = _encode_frames, args = (out_video, out_queue, encode_errors), daemon = True)
+    decoder.start()
+    encoder.start()
+    
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            i, cv_image = item
+            #if i == 155:
+                #break
+            Diag.debug("Frame # {}", i)
+            
+            start = time.time()
+            Car_obj, cv_image = _process(cv_image, Car_obj, debug)
+            end = time.time()
+            dt = (end - start)
+            Diag.info("Frame # {} {:.3f} s, {:.2f} FPS", i, dt, 1/dt)
+            out_queue.put((i, cv_image))
+            if encode_errors:
+                break
+    finally:
+        _stop_decoder(decoder, stop_decoding, frame_queue, in_video)
+        out_queue.put(None)
+        encoder.join()
+        out_video.close()
+        #out_video.release()
+    
+    if encode_errors:
+        raise encode_errors[0]
     return Car_obj, out_video
     
+#Telemetry only: per frame lane geometry goes to <file_name>_telemetry.npz
+#Runs headless, no drawing, annotation or video encoding. Decoding runs on its own thread.
+def process_video_telemetry(video_name, file_name, Car_obj, queue_size = 8):
+    in_video = imageio.get_reader(video_name)
+    fps = in_video.get_meta_data()['fps']
+    writer = Telemetry.TelemetryWriter(file_name + '_telemetry.npz', fps)
+    
+    frame_queue = queue.Queue(maxsize = queue_size)
+    stop_decoding = threading.Event()
+    decoder = threading.Thread(target = _decode_frames, args = (in_video, frame_queue, stop_decoding), daemon = True)
+    decoder.start()
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            i, cv_image = item
+            Car_obj = _process_headless(cv_image, Car_obj)
+            writer.append(i, Car_obj)
+    finally:
+        _stop_decoder(decoder, stop_decoding, frame_queue, in_video)
+    writer.close()
+    return Car_obj, writer
+    
+def process_image_telemetry(image_name, file_name, Car_obj):
+    image = cv2.imread(image_name)
+    if image is None:
+        print("Could not open image")
+    writer = Telemetry.TelemetryWriter(file_name + '_telemetry.npz')
+    Car_obj = _process_headless(image, Car_obj)
+    writer.append(0, Car_obj)
+    writer.close()
+    return Car_obj, writer
+
+#A new Car with its own copy of the configs, set up for output_mode
+#lane_overrides/bt_overrides: dicts of config values that differ for this Car
+#car_args: passed on to Car.Car (shared remaps)
+def make_car(calibration, M, Minv, lane_overrides = None, bt_overrides = None, **car_args):
+    car_lane_config = copy.deepcopy(lane_config)
+    car_bt_config = copy.deepcopy(bt_config)
+    if output_mode == 'telemetry':
+        car_lane_config['headless'] = True
+    car_lane_config.update(lane_overrides or {})
+    car_bt_config.update(bt_overrides or {})
+    return Car.Car(car_lane_config, car_bt_config, calibration, M, Minv, **car_args)
+
+#Run one input through the pipeline according to output_mode
+def process_file(input_name, file_name, file_type, Car_obj, debug = False):
+    out = None
+    if output_mode == 'telemetry':
+        if file_type == 'image':
+            Car_obj, out = process_image_telemetry(input_name, file_name, Car_obj)
+        elif file_type == 'video':
+            Car_obj, out = process_video_telemetry(input_name, file_name, Car_obj)
+    else:
+        if file_type == 'image':
+            Car_obj, out = process_image(input_name, file_name, Car_obj, debug)
+        elif file_type == 'video':
+            Car_obj, out = process_video(input_name, file_name, Car_obj, debug)
+    return Car_obj, out
+    
 def get_data_type(name):
     print(name)
     name = os.path.basename(name)
     file_name, file_ext = os.path.splitext(name)
     print(file_ext)
+    file_ext = file_ext.lower()
     if file_ext in ['.jpg', '.png']:
         print("img")
         return file_name, 'image'
@@ -172,6 +485,7 @@ def main():
     for arg in sys.argv[1:]:
         print(arg)
     input_name = sys.argv[1]
+    Diag.configure(log_level, log_file)
     #Get the calibration matrix    
     calibration = get_calibration()
     if calibration is None:
@@ -183,12 +497,11 @@ def main():
     M, Minv = laneUtils.get_warp_unwarp_matrices(warp_config)
     print(input_name)
     #Create a car object to hold everything
-    UNDCar = Car.Car(lane_config, bt_config, calibration, M, Minv)
+    UNDCar = make_car(calibration, M, Minv)
     file_name, file_type = get_data_type(input_name)
-    if (file_type is 'image'):
-        UNDCar, out_image = process_image(input_name, file_name, UNDCar, True)
-    elif (file_type is 'video'):
-        UNDCar, out_image = process_video(input_name, file_name, UNDCar, True)
+    UNDCar, out_image = process_file(input_name, file_name, file_type, UNDCar, True)
+    export_timing(UNDCar, file_name)
+    Diag.close()
     #UNDCar, out_image = process_video(input_name, UNDCar)
     
     
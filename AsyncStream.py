@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Asyncio front end for live frame sources.
+Frames come from any async iterable of BGR images (a socket or named pipe carrying
+encoded frames, a directory watcher standing in for the camera, a video file) and
+the results come back as an async stream, so the pipeline can sit on an event loop
+(e.g. the vehicle message bus) without blocking it.
+Ingest runs as its own task into a bounded queue. The Car runs on one worker thread
+(it is stateful, frames have to go through it in order). When processing falls
+behind and the queue is full, ingest either waits (backpressure on the source) or,
+with drop_oldest, drops the oldest queued frame to make room for the newest.
+
+usage:
+    stream = AsyncStream.LaneStream(AsyncStream.directory_source('incoming'), Car_obj, drop_oldest=True)
+    async for record, out_frame in stream:
+        ...     #record: Telemetry.telemetry_dtype record, out_frame: annotated frame (None if headless)
+
+    python AsyncStream.py <dir>     #watch a directory for new images
+'''
+import os, sys
+import glob
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import imageio
+
+import ALF
+import Telemetry
+import utilities as laneUtils
+
+#queue marker for the end of the source
+_end_of_stream = object()
+
+'''
+Class to run a Car over an async source of frames and emit the results as an async stream.
+source: async iterable of BGR frames
+queue_size: frames that can wait for processing
+drop_oldest: when the queue is full, drop the oldest waiting frame instead of making the source wait
+Frame numbers in the records count every frame the source gave, so dropped frames show up as gaps.
+An annotated frame is valid until the next result is asked for.
+'''
+class LaneStream():
+
+    def __init__(self, source, Car_obj, queue_size=8, drop_oldest=False):
+        self.source = source
+        self.car = Car_obj
+        self.queue_size = queue_size
+        self.drop_oldest = drop_oldest
+        #frames from the source, frames dropped, frames processed
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+
+    def __aiter__(self):
+        return self.results()
+
+    #put a frame on the queue, according to the drop policy
+    async def _put(self, frame_queue, item):
+        if self.drop_oldest and frame_queue.full():
+            frame_queue.get_nowait()
+            self.dropped += 1
+        await frame_queue.put(item)
+
+    async def _ingest(self, frame_queue):
+        try:
+            async for frame in self.source:
+                await self._put(frame_queue, (self.received, frame))
+                self.received += 1
+        except Exception as e:
+            await frame_queue.put(e)
+            return
+        #never dropped, the consumer waits for it
+        await frame_queue.put(_end_of_stream)
+
+    #runs on the worker thread
+    def _process_frame(self, i, frame):
+        Car_obj = self.car
+        out_frame = None
+        if Car_obj.headless:
+            Car_obj = ALF._process_headless(frame, Car_obj)
+        else:
+            Car_obj, out_frame = ALF._process(frame, Car_obj)
+        return Telemetry.make_record(i, Car_obj), out_frame
+
+    #async generator of (record, out_frame), one per processed frame
+    async def results(self):
+        loop = asyncio.get_running_loop()
+        frame_queue = asyncio.Queue(maxsize=self.queue_size)
+        worker = ThreadPoolExecutor(max_workers=1)
+        ingest = asyncio.ensure_future(self._ingest(frame_queue))
+        try:
+            while True:
+                item = await frame_queue.get()
+                if item is _end_of_stream:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                i, frame = item
+                result = await loop.run_in_executor(worker, self._process_frame, i, frame)
+                self.processed += 1
+                yield result
+        finally:
+            ingest.cancel()
+            worker.shutdown(wait=False)
+
+'''
+Sources. Each one is an async generator of BGR frames.
+'''
+#Frames from an asyncio StreamReader (socket or pipe): each frame is a 4 byte big endian
+#length followed by that many bytes of an encoded image (JPEG, PNG, ...). Ends at EOF
+async def reader_source(reader):
+    while True:
+        try:
+            header = await reader.readexactly(4)
+        except asyncio.IncompleteReadError:
+            return
+        length, = struct.unpack('>I', header)
+        data = await reader.readexactly(length)
+        frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is not None:
+            yield frame
+
+#Frames from clients connecting to a local TCP socket, one client at a time
+async def socket_source(host='127.0.0.1', port=5600):
+    clients = asyncio.Queue()
+    async def on_client(reader, writer):
+        done = asyncio.Event()
+        await clients.put((reader, done))
+        await done.wait()
+        writer.close()
+    server = await asyncio.start_server(on_client, host, port)
+    async with server:
+        while True:
+            reader, done = await clients.get()
+            try:
+                async for frame in reader_source(reader):
+                    yield frame
+            finally:
+                done.set()
+
+#Frames from a named pipe (same framing as reader_source). Ends when the writer closes it
+async def pipe_source(pipe_name):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    #opening a fifo blocks until there is a writer, do it off the loop
+    pipe = await loop.run_in_executor(None, open, pipe_name, 'rb', 0)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    try:
+        async for frame in reader_source(reader):
+            yield frame
+    finally:
+        transport.close()
+
+#Stand in for a camera: images showing up in a directory, in name order.
+#A file is read once its size is the same on two polls in a row (the writer is done with it),
+#and only counted as seen once it decodes. A writer that can stall for longer than a poll
+#should write to a name that doesn't match pattern and rename the file when done. A file that still doesn't decode after decode_tries
+#tries is skipped. Ends after idle_timeout seconds without a new image (never if None)
+async def directory_source(dir_name, pattern='*.jpg', poll_interval=0.05, idle_timeout=None, decode_tries=20):
+    loop = asyncio.get_running_loop()
+    seen = set()
+    #size at the last poll and failed decodes, of files not read yet
+    sizes = {}
+    tries = {}
+    idle = 0.0
+    while idle_timeout is None or idle < idle_timeout:
+        names = sorted(set(glob.glob(os.path.join(dir_name, pattern))) - seen)
+        read = 0
+        for name in names:
+            try:
+                size = os.path.getsize(name)
+            except OSError:
+                continue
+            if sizes.get(name) != size:
+                #new or still being written, look again next poll
+                sizes[name] = size
+                break
+            frame = await loop.run_in_executor(None, cv2.imread, name)
+            if frame is None:
+                tries[name] = tries.get(name, 0) + 1
+                if tries[name] < decode_tries:
+                    #maybe not complete yet, wait for its size to settle again
+                    del sizes[name]
+                    break
+            seen.add(name)
+            sizes.pop(name, None)
+            tries.pop(name, None)
+            if frame is not None:
+                read += 1
+                yield frame
+        if read == 0:
+            await asyncio.sleep(poll_interval)
+            idle += poll_interval
+        else:
+            idle = 0.0
+
+#Frames of a video file, decoded on a thread
+async def video_source(video_name):
+    loop = asyncio.get_running_loop()
+    frames = iter(imageio.get_reader(video_name))
+    while True:
+        image = await loop.run_in_executor(None, next, frames, None)
+        if image is None:
+            return
+        yield cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+async def _watch(dir_name):
+    calibration = ALF.get_calibration()
+    M, Minv = laneUtils.get_warp_unwarp_matrices(ALF.warp_config)
+    Car_obj = ALF.make_car(calibration, M, Minv, {'headless': True})
+    stream = LaneStream(directory_source(dir_name), Car_obj, drop_oldest=True)
+    async for record, _ in stream:
+        print("frame {} RoC {:.1f} m, offset {:.2f} m, {} dropped".format(
+            int(record['frame']), float(record['RoC']), float(record['dist_from_center']), stream.dropped))
+
+def main():
+    asyncio.run(_watch(sys.argv[1]))
+
+if __name__ == "__main__":
+    main()
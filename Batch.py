@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Batch processing of many videos/images with a process pool.
+Each clip gets its own Car object (lane tracking state), the calibration and
+warp matrices are loaded once and handed to every worker.
+
+usage: python Batch.py <dir | glob | manifest.txt> [output_dir] [num_workers]
+'''
+import os, sys
+import glob
+import time
+from multiprocessing import Pool
+
+import cv2
+
+import ALF
+import utilities as laneUtils
+
+media_ext = ['.jpg', '.png', '.mp4', '.avi']
+
+#shared read only data, set once per worker by init_worker
+worker_data = {}
+
+#Build the list of inputs from a directory, a glob pattern or a manifest file (one path per line)
+def collect_inputs(spec):
+    if os.path.isdir(spec):
+        names = [os.path.join(spec, n) for n in os.listdir(spec)]
+    elif os.path.isfile(spec) and os.path.splitext(spec)[1] not in media_ext:
+        manifest_dir = os.path.dirname(spec)
+        with open(spec) as f:
+            names = [os.path.join(manifest_dir, line.strip()) for line in f if line.strip() and not line.startswith('#')]
+    else:
+        names = glob.glob(spec)
+    return sorted([n for n in names if os.path.splitext(n)[1].lower() in media_ext])
+
+def init_worker(calibration, M, Minv, out_dir):
+    #one clip per process, don't let OpenCV oversubscribe the cores
+    cv2.setNumThreads(1)
+    worker_data['calibration'] = calibration
+    worker_data['M'] = M
+    worker_data['Minv'] = Minv
+    worker_data['out_dir'] = out_dir
+
+#frames per second, 0 if no time went by
+def fps(frames, dt):
+    return frames/dt if dt > 0 else 0.0
+
+#Run one clip through the pipeline with a fresh Car. Returns the clip stats.
+#A clip that fails (can't be opened or decoded, ...) doesn't stop the batch,
+#its stats then have the error
+def process_clip(input_name):
+    #every clip has its own tracking state and threshold config
+    clip_car = ALF.make_car(worker_data['calibration'], worker_data['M'], worker_data['Minv'])
+
+    #annotated video or telemetry, as set by ALF.output_mode
+    start = time.time()
+    try:
+        data_type = ALF.get_data_type(input_name)
+        if data_type is None:
+            raise ValueError("not a video or image")
+        file_name, file_type = data_type
+        file_name = os.path.join(worker_data['out_dir'], file_name)
+        clip_car, _ = ALF.process_file(input_name, file_name, file_type, clip_car)
+    except Exception as e:
+        #first line only, decoder errors carry the whole ffmpeg log
+        message = str(e).strip().split('\n')[0]
+        return {'name': input_name, 'frames': clip_car.frame_count, 'time': time.time() - start,
+                'error': '{}: {}'.format(type(e).__name__, message)}
+    end = time.time()
+    ALF.export_timing(clip_car, file_name)
+    return {'name': input_name, 'frames': clip_car.frame_count, 'time': end - start, 'error': None}
+
+def process_batch(input_names, out_dir, num_workers=None):
+    calibration = ALF.get_calibration()
+    M, Minv = laneUtils.get_warp_unwarp_matrices(ALF.warp_config)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    results = []
+    start = time.time()
+    with Pool(num_workers, initializer=init_worker, initargs=(calibration, M, Minv, out_dir)) as pool:
+        for clip in pool.imap_unordered(process_clip, input_names):
+            if clip['error'] is not None:
+                print("{}: FAILED after {} frames: {}".format(clip['name'], clip['frames'], clip['error']))
+            else:
+                print("{}: {} frames, {:.2f} s, {:.2f} FPS".format(clip['name'], clip['frames'], clip['time'], fps(clip['frames'], clip['time'])))
+            results.append(clip)
+    end = time.time()
+
+    failed = [clip for clip in results if clip['error'] is not None]
+    total_frames = sum(clip['frames'] for clip in results if clip['error'] is None)
+    dt = end - start
+    print("{} clips, {} frames, {:.2f} s, {:.2f} FPS aggregate".format(len(results) - len(failed), total_frames, dt, fps(total_frames, dt)))
+    if failed:
+        print("{} clips failed:".format(len(failed)))
+        for clip in failed:
+            print("    {}: {}".format(clip['name'], clip['error']))
+    return results
+
+def main():
+    input_names = collect_inputs(sys.argv[1])
+    out_dir = sys.argv[2] if len(sys.argv) > 2 else os.getcwd()
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    if len(input_names) == 0:
+        print("No videos or images found in ", sys.argv[1])
+        return
+    process_batch(input_names, out_dir, num_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Benchmark harness for the lane pipeline.
+Runs the full _process pipeline and the main stages on their own
+(binary_threshold, Lane.detect_lane, Lane.track_lane, Car.draw_lanes) over
+test_images/, synthetic drives made from them and optionally recorded videos.
+Reports throughput, latency percentiles and peak memory, and saves the
+results as JSON so runs can be compared across commits.
+
+usage:
+    python Benchmark.py [--videos a.mp4 ...] [--label name] [--compare old.json]
+'''
+import os
+import glob
+import copy
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+import cv2
+import numpy as np
+import imageio
+
+import ALF
+import Car
+import Lane
+import Profiler
+import BinaryThreshold as BT
+import utilities as laneUtils
+
+#Synthetic drive: every test image shifted sideways a little each frame
+#so the lanes move the way they would with the car drifting in lane
+def synthetic_sequence(images, num_frames, max_shift=40):
+    frames = []
+    for img in images:
+        for i in range(num_frames):
+            shift = max_shift*np.sin(2*np.pi*i/num_frames)
+            T = np.float32([[1, 0, shift], [0, 1, 0]])
+            frames.append(cv2.warpAffine(img, T, (img.shape[1], img.shape[0]), borderMode=cv2.BORDER_REPLICATE))
+    return frames
+
+def read_video_frames(video_name, max_frames):
+    frames = []
+    for i, image in enumerate(imageio.get_reader(video_name)):
+        if i == max_frames:
+            break
+        frames.append(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    return frames
+
+def new_car(calibration, M, Minv):
+    return Car.Car(copy.deepcopy(ALF.lane_config), copy.deepcopy(ALF.bt_config), calibration, M, Minv)
+
+'''
+Inputs for the stage benchmarks, computed once with the current pipeline:
+ROI images and warped single channel binaries
+'''
+def stage_inputs(frames, calibration, M, Minv):
+    bench_car = new_car(calibration, M, Minv)
+    rois, warped = [], []
+    for img in frames:
+        roi = bench_car.undistort_remap.undistort_roi(img, bench_car.ROI_x1, bench_car.ROI_y1)
+        success, bin_img, bench_car.bt_cfg = BT.binary_threshold(roi, bench_car.bt_cfg)
+        rois.append(roi)
+        if success:
+            warped.append(laneUtils.warp_image(bin_img, M, bench_car.bin_image_shape))
+    return rois, warped
+
+'''
+Benchmarks. Each one is (setup, run): setup() returns fresh state,
+run(state, i) processes item i. Only run() is timed.
+'''
+def full_pipeline(frames, calibration, M, Minv):
+    def setup():
+        return new_car(calibration, M, Minv)
+    def run(state, i):
+        ALF._process(frames[i], state)
+    return setup, run, len(frames)
+
+def threshold_stage(rois):
+    def setup():
+        return copy.deepcopy(ALF.bt_config)
+    def run(state, i):
+        BT.binary_threshold(rois[i], state)
+    return setup, run, len(rois)
+
+def detect_stage(warped):
+    def setup():
+        return [Lane.Lane(ALF.lane_config, 'left'), Lane.Lane(ALF.lane_config, 'right')]
+    def run(state, i):
+        #detection every frame, never switch to tracking
+        for lane in state:
+            lane.detect_lane(warped[i])
+    return setup, run, len(warped)
+
+def track_stage(warped):
+    def setup():
+        lanes = [Lane.Lane(ALF.lane_config, 'left'), Lane.Lane(ALF.lane_config, 'right')]
+        for lane in lanes:
+            lane.detect_lane(warped[0])
+        return lanes
+    def run(state, i):
+        for lane in state:
+            if lane.current_fit is not None or lane.best_fit is not None:
+                lane.track_lane(warped[i])
+    return setup, run, len(warped)
+
+def draw_stage(rois, warped, calibration, M, Minv):
+    def setup():
+        bench_car = new_car(calibration, M, Minv)
+        #get both lanes tracking so draw_lanes does the full overlay
+        for bin_img in warped:
+            bench_car.update(bin_img)
+            if bench_car.is_left_lane_tracking() and bench_car.is_right_lane_tracking():
+                break
+        #draw_lanes draws in place, every pass gets clean copies of the ROIs
+        return bench_car, [roi.copy() for roi in rois]
+    def run(state, i):
+        bench_car, canvases = state
+        bench_car.draw_lanes(canvases[i])
+    return setup, run, len(rois)
+
+#Time every item, then do one more pass under tracemalloc for peak memory
+def run_benchmark(name, bench, repeat):
+    setup, run, n = bench
+    if n == 0:
+        return None
+    timer = Profiler.StageTimer(enabled=True)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        state = setup()
+        for i in range(n):
+            t0 = timer.start()
+            run(state, i)
+            timer.stop(name, t0)
+    total = time.perf_counter() - start
+
+    state = setup()
+    tracemalloc.start()
+    for i in range(n):
+        run(state, i)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = timer.summary()[0]
+    result['fps'] = n*repeat/total
+    result['peak_mem_MB'] = peak/2**20
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def print_results(results, baseline=None):
+    print("{:<30} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}".format('benchmark', 'n', 'FPS', 'p50 ms', 'p95 ms', 'p99 ms', 'peak MB'))
+    for name, r in results.items():
+        line = "{:<30} {:>6} {:>9.2f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.2f}".format(
+            name, r['n'], r['fps'], r['p50'], r['p95'], r['p99'], r['peak_mem_MB'])
+        if baseline is not None and name in baseline:
+            line += "  x{:.2f} FPS vs baseline".format(r['fps']/baseline[name]['fps'])
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the lane pipeline')
+    parser.add_argument('--images', default=os.path.join('test_images', '*.jpg'))
+    parser.add_argument('--videos', nargs='*', default=[])
+    parser.add_argument('--max-video-frames', type=int, default=200)
+    parser.add_argument('--synthetic-frames', type=int, default=20, help='frames per test image in the synthetic drive')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--label', default=None, help='name of the results file, defaults to the git commit')
+    parser.add_argument('--out-dir', default='benchmark_results')
+    parser.add_argument('--compare', default=None, help='results JSON to compare against')
+    args = parser.parse_args()
+
+    calibration = ALF.get_calibration()
+    M, Minv = laneUtils.get_warp_unwarp_matrices(ALF.warp_config)
+
+    images = [cv2.imread(name) for name in sorted(glob.glob(args.images))]
+    sequences = {'test_images': images,
+                 'synthetic': synthetic_sequence(images, args.synthetic_frames)}
+    for video_name in args.videos:
+        sequences[os.path.splitext(os.path.basename(video_name))[0]] = read_video_frames(video_name, args.max_video_frames)
+
+    results = {}
+    for seq_name, frames in sequences.items():
+        rois, warped = stage_inputs(frames, calibration, M, Minv)
+        benches = [('process', full_pipeline(frames, calibration, M, Minv)),
+                   ('binary_threshold', threshold_stage(rois)),
+                   ('detect_lane', detect_stage(warped)),
+                   ('track_lane', track_stage(warped)),
+                   ('draw_lanes', draw_stage(rois, warped, calibration, M, Minv))]
+        for bench_name, bench in benches:
+            result = run_benchmark(bench_name, bench, args.repeat)
+            if result is not None:
+                results['{}/{}'.format(seq_name, bench_name)] = result
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    label = args.label if args.label is not None else git_commit()
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    out_name = os.path.join(args.out_dir, label + '.json')
+    report = {'label': label, 'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+              'machine': platform.machine(), 'cpus': os.cpu_count(),
+              'results': results}
+    with open(out_name, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to ", out_name)
+
+if __name__ == "__main__":
+    main()
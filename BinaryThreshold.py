@@ -11,26 +11,89 @@ Created on Wed Feb  1 20:59:43 2017
 from collections import namedtuple
 import numpy as np
 import cv2
-import utilities as cvUtils
+import Diagnostics as Diag
+import Buffers
 
 ThresholdRange = namedtuple('ThresholdRange', ['min', 'max', 'dTh'])
 
 #RdxThresh = Threshold(150, 250, 5)
 
+#Joint cumulative histogram of V and R.
+#C[v, r] = number of pixels with (V < v) & (R < r), for v, r in [0, 256]
+#If mask is given only the pixels where it is non zero are counted
+#buffers: Buffers.BufferPool to take the arrays from, a new one if None
+def joint_cumulative_histogram(R, V, mask=None, buffers=None):
+    if buffers is None:
+        buffers = Buffers.BufferPool()
+    hist = cv2.calcHist([V, R], [0, 1], mask, [256, 256], [0, 256, 0, 256],
+                        hist=buffers.get('bt_hist', (256, 256), np.float32))
+    return cv2.integral(hist, sum=buffers.get('bt_cum_hist', (257, 257), np.float64), sdepth=cv2.CV_64F)
+
+#R and V (of HSV, which is max(B, G, R)) of a BGR image, all uint8
+def red_and_value(roi, buffers=None):
+    if buffers is None:
+        buffers = Buffers.BufferPool()
+    B, G, R = [buffers.get(name, roi.shape[:2]) for name in ('bt_B', 'bt_G', 'bt_R')]
+    cv2.mixChannels([roi], [B, G, R], [0, 0, 1, 1, 2, 2])
+    V = cv2.max(B, G, dst=B)
+    V = cv2.max(V, R, dst=V)
+    return R, V
+
+#R and V of a stack of BGR images (N x H x W x 3), as N x H x W planes
+#A contiguous stack is done in one pass, as one tall image
+def red_and_value_batch(rois, buffers=None):
+    if buffers is None:
+        buffers = Buffers.BufferPool()
+    n, height, width, _ = rois.shape
+    if rois.flags['C_CONTIGUOUS']:
+        R, V = red_and_value(rois.reshape(n*height, width, 3), buffers)
+        return R.reshape(n, height, width), V.reshape(n, height, width)
+    R = buffers.get('bt_batch_R', (n, height, width))
+    V = buffers.get('bt_batch_V', (n, height, width))
+    for i in range(n):
+        R_i, V_i = red_and_value(rois[i], buffers)
+        np.copyto(R[i], R_i)
+        np.copyto(V[i], V_i)
+    return R, V
+
+#x gradient of R scaled to [0, 255] (by the largest gradient in the image), as uint8
+def red_gradient(R, buffers=None):
+    if buffers is None:
+        buffers = Buffers.BufferPool()
+    R_dx = cv2.Sobel(R, cv2.CV_16S, 1, 0, dst=buffers.get('bt_R_dx', R.shape, np.int16))
+    min_dx, max_dx, _, _ = cv2.minMaxLoc(R_dx)
+    max_dx = max(abs(min_dx), abs(max_dx), 1)
+    return cv2.convertScaleAbs(R_dx, dst=buffers.get('bt_grad', R.shape), alpha=255/max_dx)
+
+#Number of pixels that pass (V >= V_Thresh) | (R >= R_Thresh), read off the cumulative histogram
+def count_above(C, R_Thresh, V_Thresh):
+    v = min(max(int(V_Thresh), 0), 256)
+    r = min(max(int(R_Thresh), 0), 256)
+    return C[-1, -1] - C[v, r]
+
 #Adaptive Binary Threshold.
 #We use R channel from RGB and V from HSV.
+#Optionally (config['gradient']) pixels with a strong x gradient of R (>= config['gradient_thresh'])
+#are always lane pixels. They are counted once and left out of the histogram.
 #We iteratively find threshold parameters that give just enough pixels.
+#The search runs on a joint cumulative histogram of R and V, so each step is a lookup.
+#The mask is only built once, for the final thresholds.
 ## Input:
     #ROI image:3 channel
     #Initial values for R and V
     #Bailout: max iterations
+    #buffers: optional Buffers.BufferPool the arrays are taken from (the binary image too)
+    #features: optional (R, V) of roi if already computed (red_and_value_batch). They get overwritten
+    #deadline: optional Profiler.Deadline. If it expires during the search, the search stops
+    #          and the thresholds of the previous frame are used (config['deadline_cut'])
 ## Output:
-    #Binary image: 3 channel
+    #Binary image: single channel
     #RthreshValue
     #VthreshValue
+    #number of search steps (config['steps'])
 # input ROI image is 3 channel
-# returns a 3channel Binary image (0 and 255)
-def binary_threshold(roi, config):
+# returns a single channel uint8 Binary image (0 and 255)
+def binary_threshold(roi, config, buffers=None, features=None, deadline=None):
     
     R_Range = config['R_Range']
     V_Range = config['V_Range']
@@ -40,24 +103,33 @@ def binary_threshold(roi, config):
     minLane = config['minLane']
     maxLane = config['maxLane']
         
-    thresh_img = np.zeros_like(roi[:, :, 0])
+    if buffers is None:
+        buffers = Buffers.BufferPool()
+    thresh_img = buffers.get('bt_thresh', roi.shape[:2])
     
     total_pixels = thresh_img.shape[0]*thresh_img.shape[1]
     
-    #Using R and G channels to mask out dark or grey road/ shadow values
-    (B,G,R) = cv2.split(roi)
-    
-    R_dx = np.absolute(cv2.Sobel(R, cv2.CV_64F, 1, 0))
-    R_dx *= 255/np.max(R_dx)
+    #Using R and V channels to mask out dark or grey road/ shadow values
+    if features is None:
+        R, V = red_and_value(roi, buffers)
+    else:
+        R, V = features
     
-    hsv = cvUtils.colorspace(roi, cv2.COLOR_BGR2HSV)
-    V = cvUtils.get_channel(hsv, 2)
+    #gradient pixels pass whatever the R and V thresholds are
+    grad_img = None
+    grad_count = 0
+    hist_mask = None
+    if config['gradient']:
+        grad_img = red_gradient(R, buffers)
+        cv2.threshold(grad_img, config['gradient_thresh'] - 1, 255, cv2.THRESH_BINARY, dst=grad_img)
+        grad_count = cv2.countNonZero(grad_img)
+        hist_mask = cv2.bitwise_not(grad_img, dst=buffers.get('bt_hist_mask', roi.shape[:2]))
     
-    #Create an initial binary image. We will refine this if we don't have enough pixels or too many pixels
-    thresh_img[(V >= V_Thresh) | (R >= R_Thresh)] = 255
+    #Count pixels for any threshold pair without touching the image again
+    C = joint_cumulative_histogram(R, V, hist_mask, buffers)
     
-    #Count of Non-Zero mask pixels
-    nzcount = np.count_nonzero(thresh_img)
+    #Count of Non-Zero mask pixels for the initial thresholds. We will refine this if we don't have enough pixels or too many pixels
+    nzcount = count_above(C, R_Thresh, V_Thresh) + grad_count
     
     #Bailout Counter. If we can not reach a good value in n steps, stop wasting time and move on.
     counter = 0
@@ -69,15 +141,22 @@ def binary_threshold(roi, config):
     maxarea = maxLane * total_pixels
     
     success = True
+    deadline_cut = False
     ddth = 0
     while ((nzcount < minarea) | (nzcount >= maxarea)) & (wiggleScope):
         
-        print(nzcount/total_pixels, counter, R_Thresh, V_Thresh)
+        Diag.debug("{} {} {} {}", nzcount/total_pixels, counter, R_Thresh, V_Thresh)
+        if deadline is not None and deadline.expired():
+            Diag.info("Out of time after {} steps. Using the last thresholds", counter)
+            R_Thresh = config['R_best']
+            V_Thresh = config['V_best']
+            deadline_cut = True
+            break
         counter += 1
         if (counter == int(bailout/2)):
             ddth = 3
         if (counter == bailout):
-            print("Unable to find a good value in {} steps. Bailing out!".format(bailout))
+            Diag.warning("Unable to find a good value in {} steps. Bailing out!", bailout)
             success = False
             break
             
@@ -98,24 +177,30 @@ def binary_threshold(roi, config):
                 if RwiggleScope:
                     R_Thresh += (R_Range.dTh - ddth)
                     
-            thresh_img = np.zeros_like(thresh_img)
-            thresh_img[(V >= V_Thresh) | (R >= R_Thresh)] = 255
-            nzcount = np.count_nonzero(thresh_img)
+            nzcount = count_above(C, R_Thresh, V_Thresh) + grad_count
             
         else:
-            print("Unable to find a good value in range. Bailing out!")
+            Diag.warning("Unable to find a good value in range. Bailing out!")
             success = False
             break    
     
-    print("{:.2f} %cnt, {} steps, {} nzcnt".format(nzcount/total_pixels, counter, total_pixels))
+    Diag.debug("{:.2f} %cnt, {} steps, {} nzcnt", nzcount/total_pixels, counter, total_pixels)
+    
+    #Create the binary image once with the thresholds we settled on
+    #V and R are not needed after this, threshold them in place
+    cv2.threshold(V, V_Thresh - 1, 255, cv2.THRESH_BINARY, dst=V)
+    cv2.threshold(R, R_Thresh - 1, 255, cv2.THRESH_BINARY, dst=R)
+    cv2.bitwise_or(V, R, dst=thresh_img)
+    if grad_img is not None:
+        cv2.bitwise_or(thresh_img, grad_img, dst=thresh_img)
         
-    bin_img = np.dstack((thresh_img, thresh_img, thresh_img))
+    bin_img = thresh_img
     config['R_best'] = R_Thresh
     config['V_best'] = V_Thresh
+    config['steps'] = counter
+    config['deadline_cut'] = deadline_cut
 
     if not success:
-        nzcount = np.count_nonzero(thresh_img)
-        thresh_img = np.zeros_like(thresh_img)
         config['R_best'] = config['R_init']
         config['V_best'] = config['V_init']
     return success, bin_img, config
@@ -0,0 +1,49 @@
+'''
+Class to hold the reusable arrays of the per frame pipeline. Owned by the Car.
+Every stage asks for its buffers by name with the shape and dtype it needs and
+writes into them with OpenCV dst= / NumPy out=. An array is only allocated the
+first time a name is asked for (or if the shape/dtype changes), so steady state
+processing does no large allocations.
+A buffer is valid until the same name is asked for again, usually the next
+frame. Names with more than one slot (set_slots) rotate through their slots,
+for buffers that are handed to another thread (e.g. frames waiting to be encoded).
+'''
+import numpy as np
+
+class BufferPool():
+
+    def __init__(self):
+        #(name, slot) -> array
+        self.buffers = {}
+        #name -> number of slots, and the slot the next get will return
+        self.slots = {}
+        self.next_slot = {}
+
+    def set_slots(self, name, num_slots):
+        self.slots[name] = max(int(num_slots), 1)
+        self.next_slot[name] = 0
+
+    #array for name with this shape and dtype. Contents are whatever the last user left
+    def get(self, name, shape, dtype=np.uint8):
+        slot = self.next_slot.get(name, 0)
+        self.next_slot[name] = (slot + 1) % self.slots.get(name, 1)
+        shape = tuple(shape)
+        buf = self.buffers.get((name, slot))
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self.buffers[(name, slot)] = buf
+        return buf
+
+    #same as get, set to 0
+    def zeros(self, name, shape, dtype=np.uint8):
+        buf = self.get(name, shape, dtype)
+        buf.fill(0)
+        return buf
+
+    #total bytes held by the pool
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self.buffers.values())
+
+    def clear(self):
+        self.buffers = {}
+        self.next_slot = {}
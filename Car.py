@@ -3,27 +3,53 @@ Class to hold Vehicle related data. This gets added to the Deque
 
 '''
 import Lane
+import Remap
+import Profiler
+import Buffers
+import Diagnostics as Diag
 import numpy as np
 import utilities as laneUtils
 import cv2
 
 class Car():
-    def __init__(self, lane_config, bt_config, camera_calibration, M, Minv):
+    #undistort_remap/birds_eye_remap: Remap objects to share with other Cars (read only), built here if None
+    def __init__(self, lane_config, bt_config, camera_calibration, M, Minv, undistort_remap=None, birds_eye_remap=None):
         
         self.lane_cfg = lane_config
         self.bt_cfg = bt_config
+        #per stage latency recorder, shared with the Lane objects
+        self.timer = Profiler.StageTimer(lane_config['profile'])
+        #per frame time budget (real time mode) and what it cost
+        self.deadline = Profiler.Deadline(lane_config['deadline_ms'])
+        self.deadline_stats = {'frames': 0, 'missed': 0, 'threshold_cut': 0, 'lanes_skipped': 0, 'frames_skipped': 0}
+        #reusable per frame arrays, every stage writes into these
+        self.buffers = Buffers.BufferPool()
         self.cam_calib = camera_calibration
+        #undistortion tables are built once and reused for every frame
+        if undistort_remap is None:
+            undistort_remap = Remap.UndistortRemap(camera_calibration)
+        self.undistort_remap = undistort_remap
         self.warp_M = M
         self.warp_Minv = Minv
         
+        #ROI crop and the fused raw -> bird's eye remap
+        self.ROI_x1 = lane_config['ROI_x1']
+        self.ROI_y1 = lane_config['ROI_y1']
+        self.fused_remap = lane_config['fused_remap']
+        if birds_eye_remap is None:
+            birds_eye_remap = Remap.BirdsEyeRemap(self.undistort_remap, Minv, self.ROI_x1, self.ROI_y1, lane_config['bin_image_shape'])
+        self.birds_eye_remap = birds_eye_remap
+        
         self.scale_X = lane_config['scale_X']
         self.scale_Y = lane_config['scale_Y']
         #tuple (X, Y)
         self.bin_image_shape = lane_config['bin_image_shape']
+        #headless: no lane debug images
+        self.headless = lane_config['headless']
         
         ###Line Objects
-        self.left_Line = Lane.Lane(lane_config, 'left')
-        self.right_Line = Lane.Lane(lane_config, 'right')
+        self.left_Line = Lane.Lane(lane_config, 'left', self.timer, self.buffers)
+        self.right_Line = Lane.Lane(lane_config, 'right', self.timer, self.buffers)
         
         self.min_lane_width = lane_config['min_lane_width']
         self.max_lane_width = lane_config['max_lane_width']
@@ -41,18 +67,57 @@ class Car():
         #radius of curvature of the car in meters
         self.RoC = None
         
-    def get_lanes(self, successFlag, bin_img):
-        lane_img = np.zeros((self.bin_image_shape[1], self.bin_image_shape[0], 3))
-        if successFlag:
-            #Warp ROI to Bird's Eye view
-            warped_bin_img = laneUtils.warp_image(bin_img, self.warp_M, self.bin_image_shape)
-            #only need single channel
-            warped_bin_img = warped_bin_img[:,:,0]
+        #number of frames run through the pipeline with this car
+        self.frame_count = 0
+        
+    #start the time budget of a new frame
+    def start_frame(self):
+        self.deadline.start()
+        self.deadline_stats['frames'] += 1
+    
+    #count the frame as a deadline miss if it went over budget
+    def end_frame(self):
+        if self.deadline.expired():
+            overrun = self.deadline.overrun_ms()
+            self.deadline_stats['missed'] += 1
+            self.timer.count('deadline_overrun_ms', overrun)
+            Diag.info("Frame {} over its deadline by {:.2f} ms", self.frame_count, overrun)
+    
+    #frame skipped for lack of time. The lanes keep their fits, but the frame counts as one
+    #without a detection, so a stale fit is not tracked for more than no_track_frames
+    def skip_frame(self):
+        self.deadline_stats['frames_skipped'] += 1
+        self.update(None)
+    
+    #bin_img: single channel binary. If warped is True, it is already in bird's eye view (fused remap)
+    #returns the lane debug image, None if headless
+    def get_lanes(self, successFlag, bin_img, warped=False):
+        lane_img = None
+        if not self.headless:
+            lane_img = self.buffers.get('lane_img', (self.bin_image_shape[1], self.bin_image_shape[0], 3))
+        if successFlag and self.deadline.expired():
+            #no time left to search for the lanes, they keep their fits (and age like in skip_frame)
+            self.deadline_stats['lanes_skipped'] += 1
+            self.update(None)
+        elif successFlag:
+            if warped:
+                warped_bin_img = bin_img
+            else:
+                #Warp ROI to Bird's Eye view
+                t0 = self.timer.start()
+                warped_bin_img = laneUtils.warp_image(bin_img, self.warp_M, self.bin_image_shape,
+                                                      dst=self.buffers.get('warped_bin', (self.bin_image_shape[1], self.bin_image_shape[0])))
+                self.timer.stop('warp', t0)
 
             left_lane_img, right_lane_img = self.update(warped_bin_img)
-            lane_img = cv2.addWeighted(left_lane_img, 1, right_lane_img, 1, 0)
+            if not self.headless:
+                cv2.addWeighted(left_lane_img, 1, right_lane_img, 1, 0, dst=lane_img)
+                return lane_img
         else:
             _,_ = self.update(None)
+        #no lanes searched this frame, blank debug image
+        if lane_img is not None:
+            lane_img.fill(0)
         return lane_img
       
     def update(self, bin_img=None):
@@ -63,13 +128,18 @@ class Car():
             self.right_Line.update_state()
             return None, None
             
-        out_left_img, left_found = self.left_Line.find_lane(bin_img)
-        out_right_img, right_found = self.right_Line.find_lane(bin_img)
+        #non zero pixels indexed by row, built once for both lanes
+        pixels = Lane.LanePixels(bin_img)
+        out_left_img, left_found = self.left_Line.find_lane(bin_img, pixels)
+        out_right_img, right_found = self.right_Line.find_lane(bin_img, pixels)
         
         #if both left and right found, proceed with sanity check
         #If sanity check has failed, the current fit is bad
         if left_found and right_found:
-            if not self.sanity_check():
+            t0 = self.timer.start()
+            sane = self.sanity_check()
+            self.timer.stop('sanity_check', t0)
+            if not sane:
                 self.left_Line.current_fit=None
                 self.right_Line.current_fit=None
         else:
@@ -89,14 +159,14 @@ class Car():
     Function to check if the lines are intersecting or too close
     '''
     def sanity_check(self):
-        print("sanity checking")
+        Diag.debug("sanity checking")
         dist = np.abs(self.left_Line.curr_x - self.right_Line.curr_x)
         min_dist_between_lanes = np.min(dist)
         max_dist_between_lanes = np.max(dist)
-        print('min dist ', min_dist_between_lanes)
-        print('max dist ', min_dist_between_lanes)
+        Diag.debug("min dist {}", min_dist_between_lanes)
+        Diag.debug("max dist {}", max_dist_between_lanes)
         if min_dist_between_lanes < self.min_lane_width or max_dist_between_lanes  > self.max_lane_width:
-            print("Lines are too close or too far")
+            Diag.info("Lines are too close or too far")
             return False
         #if abs(left_roc - right_roc) > 1000:
             #return False
@@ -133,45 +203,47 @@ class Car():
         points_pixels.append(self.right_Line.calc_lane_points())
         return points_pixels                                
         
-    #draw the left and right lanes on the colored image
-    #Take the ROI image. Warp it bird's eye view.
-    #Plot the lines and then warp it back to original view
-    #Returns 
+    #bird's eye points (N x 2, x and y) to ROI coordinates through warp_Minv
+    def birds_eye_to_roi(self, pts):
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(pts, self.warp_Minv).reshape(-1, 2)
+        
+    #draw the left and right lanes on the colored image, in place
+    #The lane area and the lane lines are polygons in bird's eye view. We project
+    #their points into the ROI and fill/blend them there, only inside their bounding box.
+    #Returns the ROI and if the lanes were drawn
     def draw_lanes(self, roi):
         out_img = roi
-        print("Drawing lane")
+        Diag.debug("Drawing lane")
         
         if (self.is_right_lane_tracking() and self.is_left_lane_tracking()):
-            print("Left and right are tracking")
+            Diag.debug("Left and right are tracking")
             
-            #Warp to bird's eye view
-            warped_roi = laneUtils.warp_image(roi, self.warp_M, self.bin_image_shape)
-        
             left_points = self.left_Line.calc_lane_points()
-            right_points = np.flipud(self.right_Line.calc_lane_points())
-            pts = np.vstack((left_points, right_points))
-    
-            # Draw the lane onto the warped blank image
-            warped_roi = cv2.polylines(warped_roi, np.int32([left_points]), isClosed=False, color=(255, 255, 0), thickness=5)
-            
-            warped_roi = cv2.polylines(warped_roi, np.int32([right_points]), isClosed=False, color=(255, 255, 0), thickness=5)
+            right_points = self.right_Line.calc_lane_points()
             
-            #out_img = cv2.addWeighted(left_img,0.5, right_img, 0.5, 0)
-            warped_roi = cv2.fillPoly(warped_roi, np.int_([pts]), (0,255, 0))
-            unwarped_lane_roi = laneUtils.warp_image(warped_roi, self.warp_Minv, (roi.shape[1], roi.shape[0]))
+            #lines are 5 bird's eye pixels wide, so they get thinner with distance
+            lane_area = self.birds_eye_to_roi(np.vstack((left_points, np.flipud(right_points))))
+            left_line = self.birds_eye_to_roi(laneUtils.line_strip(left_points, 2.5))
+            right_line = self.birds_eye_to_roi(laneUtils.line_strip(right_points, 2.5))
+            lane_area, left_line, right_line = [np.int32(np.round(pts)) for pts in [lane_area, left_line, right_line]]
             
-            _,g,_ = cv2.split(unwarped_lane_roi)
-            #img2gray = unwarped_roi[unwarped_roicv2.cvtColor(unwarped_roi,cv2.COLOR_BGR2GRAY)
-            ret, mask = cv2.threshold(g, 254, 255, cv2.THRESH_BINARY)
-            mask_inv = cv2.bitwise_not(mask)
+            #bounding box of everything we draw, clipped to the ROI
+            x, y, w, h = cv2.boundingRect(np.vstack((lane_area, left_line, right_line)))
+            x1, y1 = max(x, 0), max(y, 0)
+            x2, y2 = min(x + w, roi.shape[1]), min(y + h, roi.shape[0])
+            if x2 <= x1 or y2 <= y1:
+                return out_img, True
+            roi_box = roi[y1:y2, x1:x2]
             
-            #Blank out all area except fro lane on warped image with lanes drawn
-            img_fg = cv2.bitwise_and(unwarped_lane_roi, unwarped_lane_roi, mask=mask)
-            #blank out area in original roi
-            img_bg = cv2.bitwise_and(roi, roi, mask=mask_inv)
+            overlay = self.buffers.get('draw_overlay', roi_box.shape)
+            np.copyto(overlay, roi_box)
+            cv2.fillPoly(overlay, [left_line, right_line], (255, 255, 0), offset=(-x1, -y1))
+            cv2.fillPoly(overlay, [lane_area], (0, 255, 0), offset=(-x1, -y1))
             
-            final_roi = cv2.add(img_bg, img_fg)
-            out_img = cv2.addWeighted(final_roi, 0.4,roi, 0.6, 0)
+            #overlay is roi_box outside the polygons, so this only tints the lane
+            cv2.addWeighted(overlay, 0.4, roi_box, 0.6, 0, dst=overlay)
+            np.copyto(roi_box, overlay)
             return out_img, True
         return out_img, False
         
@@ -0,0 +1,113 @@
+'''
+Leveled diagnostics for the lane pipeline. Replaces the print calls in the
+per frame code.
+Off by default: a call below the current level returns before anything is
+formatted. When on, records (time, level, format string, args) go into an
+in memory ring buffer and a background thread formats and writes them out.
+
+usage:
+    import Diagnostics as Diag
+    Diag.configure(Diag.DEBUG, 'log.txt')
+    Diag.debug("{} steps", counter)
+    Diag.close()
+'''
+from collections import deque
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+OFF = 100
+
+level_names = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING'}
+
+#current level. Anything below it is dropped at the call site
+level = OFF
+
+#ring buffer of records. When full the oldest records are dropped
+records = deque(maxlen=10000)
+
+#where the flusher writes to, and how often
+out_stream = None
+flush_interval = 0.5
+flusher = None
+stop_event = threading.Event()
+
+
+def enabled(lvl):
+    return lvl >= level
+
+def debug(msg, *args):
+    if DEBUG < level:
+        return
+    records.append((time.time(), DEBUG, msg, args))
+
+def info(msg, *args):
+    if INFO < level:
+        return
+    records.append((time.time(), INFO, msg, args))
+
+def warning(msg, *args):
+    if WARNING < level:
+        return
+    records.append((time.time(), WARNING, msg, args))
+
+#formatted text of one record
+def format_record(record):
+    t, lvl, msg, args = record
+    if args:
+        msg = msg.format(*args)
+    return "{:.6f} {} {}".format(t, level_names[lvl], msg)
+
+#write out everything in the buffer. Called by the flusher thread and on close
+def flush():
+    if out_stream is None:
+        return
+    lines = []
+    while True:
+        try:
+            lines.append(format_record(records.popleft()))
+        except IndexError:
+            break
+    if lines:
+        out_stream.write('\n'.join(lines) + '\n')
+        out_stream.flush()
+
+def _flush_loop():
+    while not stop_event.wait(flush_interval):
+        flush()
+
+'''
+configure: set the level and where records go
+input: lvl: DEBUG, INFO, WARNING or OFF
+       file_name: file to write to, '-' for stdout, None to only keep the ring buffer in memory
+       capacity: ring buffer size (records)
+       interval: seconds between background flushes
+'''
+def configure(lvl, file_name='-', capacity=10000, interval=0.5):
+    global level, records, out_stream, flush_interval, flusher
+    close()
+    level = lvl
+    records = deque(maxlen=capacity)
+    flush_interval = interval
+    if lvl >= OFF or file_name is None:
+        return
+    out_stream = sys.stdout if file_name == '-' else open(file_name, 'w')
+    stop_event.clear()
+    flusher = threading.Thread(target=_flush_loop, daemon=True)
+    flusher.start()
+
+#stop the flusher, write out what is left and turn diagnostics off
+def close():
+    global level, out_stream, flusher
+    if flusher is not None:
+        stop_event.set()
+        flusher.join()
+        flusher = None
+    flush()
+    if out_stream is not None and out_stream is not sys.stdout:
+        out_stream.close()
+    out_stream = None
+    level = OFF
@@ -3,15 +3,181 @@ Class to hold Lane data.
 We put user facing things here:
 RoC, distance from center
 '''
-from collections import deque
 import numpy as np
 import cv2
+import Profiler
+import Buffers
+import Diagnostics as Diag
+
+'''
+Class to hold the non zero pixels of a warped binary image, indexed by row.
+Built once per frame and shared by the left and right Lane searches.
+nonzero() walks the image row by row, so the pixels are already sorted by
+row (and by x within a row). They are keyed by y*width + x (sorted, since
+that is the order nonzero() gives) with a running sum of x, so the pixel
+count and mean x of a sliding window, or of the band tracked around a fit,
+take one binary search per row.
+'''
+class LanePixels():
+    
+    def __init__(self, bin_img):
+        self.shape = bin_img.shape
+        self.y, self.x = bin_img.nonzero()
+        self.key = self.y*self.shape[1] + self.x
+        self.cum_x = np.zeros(len(self.x) + 1, dtype=np.int64)
+        np.cumsum(self.x, out=self.cum_x[1:])
+        
+    '''
+    window: pixels in rows [y1, y2), columns [x1, x2)
+    x1/x2 are either one value for all the rows or one value per row (a band around a fit)
+    output: the rows actually covered (slice), and per row pixel count and sum of x
+    '''
+    def window(self, y1, y2, x1, x2):
+        y1 = min(max(y1, 0), self.shape[0])
+        y2 = min(max(y2, y1), self.shape[0])
+        if isinstance(x1, np.ndarray):
+            x1 = np.clip(x1, 0, self.shape[1])
+            x2 = np.clip(x2, x1, self.shape[1])
+        else:
+            x1 = min(max(x1, 0), self.shape[1])
+            x2 = min(max(x2, x1), self.shape[1])
+        row_keys = np.arange(y1, y2)*self.shape[1]
+        lo = np.searchsorted(self.key, row_keys + x1)
+        hi = np.searchsorted(self.key, row_keys + x2)
+        return slice(y1, y2), hi - lo, self.cum_x[hi] - self.cum_x[lo]
+
+'''
+Class to fit x = f(y) polynomials by accumulating the normal equation moments
+(sum of y^k and of x*y^k) instead of building the full Vandermonde of all the
+pixels. Moments can be added per pixel, or per row (count and sum of x in the
+row) which is what the sliding windows give us for free. Solving is a
+(degree+1)x(degree+1) system.
+y is scaled to u = y/(height-1) while accumulating to keep the system well conditioned.
+'''
+class LaneFitter():
+    
+    def __init__(self, height, degree=2):
+        self.height = height
+        self.degree = degree
+        self.scale = float(max(height - 1, 1))
+        #u^k for every row, k = 0..2*degree
+        u = np.arange(height)/self.scale
+        self.powers = u[:, np.newaxis]**np.arange(2*degree + 1)
+        #normal matrix entry (i, j) is the moment of u^(i+j)
+        self.hankel = np.add.outer(np.arange(degree + 1), np.arange(degree + 1))
+        self.clear()
+        
+    def clear(self):
+        self.yy = np.zeros(2*self.degree + 1)
+        self.xy = np.zeros(self.degree + 1)
+        self.n = 0
+        
+    #rows: row indices (or a slice), counts/sum_x: (weighted) pixel count and sum of x in each row
+    def add_rows(self, rows, counts, sum_x):
+        P = self.powers[rows]
+        self.yy += np.dot(counts, P)
+        self.xy += np.dot(sum_x, P[:, :self.degree + 1])
+        self.n += np.sum(counts)
+        
+    #lane pixels, optionally weighted
+    def add_pixels(self, lane_y, lane_x, weights=None):
+        if weights is None:
+            counts = np.bincount(lane_y, minlength=self.height)
+            sum_x = np.bincount(lane_y, weights=lane_x, minlength=self.height)
+        else:
+            counts = np.bincount(lane_y, weights=weights, minlength=self.height)
+            sum_x = np.bincount(lane_y, weights=weights*lane_x, minlength=self.height)
+        self.add_rows(slice(0, self.height), counts, sum_x)
+        
+    #polynomial coefficients in y, highest power first (same as np.polyfit)
+    def solve(self):
+        A = self.yy[self.hankel]
+        try:
+            coeffs = np.linalg.solve(A, self.xy)
+        except np.linalg.LinAlgError:
+            coeffs = np.linalg.lstsq(A, self.xy, rcond=None)[0]
+        #coefficients of u^k back to coefficients of y^k
+        coeffs = coeffs/self.scale**np.arange(self.degree + 1)
+        return coeffs[::-1]
+
+'''
+Class to hold the last n lane fits in a fixed size ring buffer.
+The running (weighted) sum is updated in O(1) per fit instead of averaging
+the whole history every frame.
+mode: 'mean'       - plain average of the last n fits
+      'confidence' - average weighted by the confidence given with each fit
+      'ewma'       - exponentially weighted average, alpha for the newest fit
+'''
+class FitHistory():
+    
+    def __init__(self, maxlen, n_coeffs=3, mode='mean', alpha=0.2):
+        self.maxlen = maxlen
+        self.mode = mode
+        self.alpha = alpha
+        self.fits = np.zeros((maxlen, n_coeffs))
+        self.weights = np.zeros(maxlen)
+        self.clear()
+        
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        self.fit_sum = np.zeros(self.fits.shape[1])
+        self.weight_sum = 0.0
+        self.ewma = None
+        
+    def __len__(self):
+        return self.count
+    
+    def append(self, fit, weight=1.0):
+        if self.mode != 'confidence':
+            weight = 1.0
+        if self.count == self.maxlen:
+            #drop the oldest fit from the running sums
+            self.fit_sum -= self.weights[self.head]*self.fits[self.head]
+            self.weight_sum -= self.weights[self.head]
+        else:
+            self.count += 1
+        self.fits[self.head] = fit
+        self.weights[self.head] = weight
+        self.fit_sum += weight*self.fits[self.head]
+        self.weight_sum += weight
+        self.head = (self.head + 1) % self.maxlen
+        
+        #resync the running sums once per trip round the buffer so rounding can't build up
+        if self.head == 0:
+            self.fit_sum = self.weights.dot(self.fits)
+            self.weight_sum = np.sum(self.weights)
+        
+        if self.ewma is None:
+            self.ewma = np.array(self.fits[self.head - 1])
+        else:
+            self.ewma = self.alpha*self.fits[self.head - 1] + (1 - self.alpha)*self.ewma
+            
+    #averaged fit (new array), None if there are no fits
+    def average(self):
+        if self.count == 0:
+            return None
+        if self.mode == 'ewma':
+            return np.array(self.ewma)
+        return self.fit_sum/self.weight_sum
+
+#Radius of curvature of x = A*y^2 + B*y + C at y (same units as the fit)
+def radius_of_curvature(fit, y_eval):
+    return ((1 + (2*fit[0]*y_eval + fit[1])**2)**1.5) / np.absolute(2*fit[0])
 
 class Lane():
     
-    def __init__(self, lane_cfg, lane_type='left'):
+    def __init__(self, lane_cfg, lane_type='left', timer=None, buffers=None):
         
         self.lane_type = lane_type
+        #per stage latency recorder (usually the one owned by Car)
+        if timer is None:
+            timer = Profiler.StageTimer()
+        self.timer = timer
+        #pool the debug images are drawn into (usually the one owned by Car)
+        if buffers is None:
+            buffers = Buffers.BufferPool()
+        self.buffers = buffers
         self.tracking_memory = lane_cfg['tracking_memory']
         self.no_track_frames = lane_cfg['no_track_frames']
         
@@ -22,6 +188,8 @@ class Lane():
         #scales in X and Y (meters/ pixels)
         self.scale_X = lane_cfg['scale_X']
         self.scale_Y = lane_cfg['scale_Y']
+        #x = A*y^2 + B*y + C in pixels is x = (sX/sY^2)*A*y^2 + (sX/sY)*B*y + sX*C in meters
+        self.world_scale = np.array([self.scale_X/self.scale_Y**2, self.scale_X/self.scale_Y, self.scale_X])
         
         self.hist_height = lane_cfg['hist_height']
         self.sw_height = lane_cfg['sw_height']
@@ -33,6 +201,9 @@ class Lane():
 
         self.min_RoC = lane_cfg['min_RoC']
         
+        #headless: only compute fits, no debug images are allocated or drawn
+        self.headless = lane_cfg['headless']
+        
         # is it tracking
         self.is_tracking = False
         
@@ -40,13 +211,15 @@ class Lane():
         self.no_lane_detected_frames = 0
         
         # x values of the last n fits of the line
-        self.recent_fits = deque(maxlen = self.tracking_memory)
+        self.recent_fits = FitHistory(self.tracking_memory, mode=lane_cfg['fit_averaging'], alpha=lane_cfg['ewma_alpha'])
         
         #polynomial coefficients averaged over the last n iterations
         self.best_fit = None  
         
         #polynomial coefficients for the most recent fit
         self.current_fit = None
+        #confidence in the most recent fit (number of lane pixels it was fit to)
+        self.current_confidence = 0
         self.curr_x = None
         #self.curr_roc = None
         
@@ -59,6 +232,18 @@ class Lane():
         #bposition of base of lane
         self.base_pos = None
         
+        #normal equation fitters per (height, degree)
+        self.fitters = {}
+        
+        #Vandermonde bases per (height, degree), so evaluating a fit over all rows is one dot product
+        self.bases = {}
+        #[y_eval^2, y_eval, 1] at the base of the image
+        self.base_basis = np.vander([float(self.bin_image_shape[1])], 3)[0]
+        
+        #lane points of best_fit, and the best_fit they were computed for
+        self.lane_points = None
+        self.lane_points_fit = None
+        
 	
     #when a few frames go by without new lanes, we need to restart from scratch. clear out older data
     #this flag will also be used by the histogram/ sw algorithm to do its thing
@@ -71,34 +256,65 @@ class Lane():
         self.base_pos = None
         self.curr_roc = None
 	
+    #plot_y (0 to height-1) and its Vandermonde basis [y^degree ... y, 1], built once per shape
+    def get_basis(self, height, degree=2):
+        key = (height, degree)
+        if key not in self.bases:
+            plot_y = np.linspace(0, height-1, height)
+            self.bases[key] = (plot_y, np.vander(plot_y, degree+1))
+        return self.bases[key]
+    
+    def get_fitter(self, height, degree=2):
+        key = (height, degree)
+        if key not in self.fitters:
+            self.fitters[key] = LaneFitter(height, degree)
+        fitter = self.fitters[key]
+        fitter.clear()
+        return fitter
+    
+    #x of a fit for every row of an image height pixels high
+    def eval_fit(self, fit, height):
+        plot_y, basis = self.get_basis(height, len(fit)-1)
+        return plot_y, basis.dot(fit)
+    
+    #3 channel copy of bin_img to draw on, in this lane's pooled buffer name (valid until the next frame)
+    def debug_image(self, bin_img, name):
+        out_img = self.buffers.get(self.lane_type + '_' + name, bin_img.shape + (3,))
+        return cv2.merge((bin_img, bin_img, bin_img), dst=out_img)
+	
     '''
     fit_line: function to fit n degree polynomial to lane pixels
     input: lane_pixels: (x and y locations of the putative lane pixels)
 	       degree of polynomial: 2 or 3
+	       weights: optional per pixel weights
     output: line_fit: polynomial equation of line
+    returns the debug image, None if headless
     '''
-    def fit_line(self, bin_img, lane_pixels, degree=2):
-        self.current_fit = None
-        self.curr_x = None
-        out_img = np.dstack((bin_img, bin_img, bin_img))
+    def fit_line(self, bin_img, lane_pixels, degree=2, weights=None):
         # Fit a n order polynomial
         lane_y, lane_x = lane_pixels
-        self.current_fit = np.polyfit(lane_y, lane_x, degree)
-        
+        fitter = self.get_fitter(bin_img.shape[0], degree)
+        fitter.add_pixels(lane_y, lane_x, weights)
+        return self.fit_from_moments(bin_img, fitter)
+    
+    #solve the fit from the moments accumulated in fitter and update current_fit/curr_x
+    #returns the debug image, None if headless
+    def fit_from_moments(self, bin_img, fitter):
+        self.current_fit = fitter.solve()
+        self.current_confidence = fitter.n
         
         # Generate x and y values for plotting
-        #linespace for y, we know y is height pixels long
-        plot_y = np.linspace(0, bin_img.shape[0]-1, bin_img.shape[0])
-        #get values of x for corresponding y
-        fit_x = 0
-        for deg,coeff in enumerate(self.current_fit[::-1]):
-            fit_x += coeff*(plot_y**deg)
+        #y is height pixels long, get values of x for corresponding y
+        plot_y, fit_x = self.eval_fit(self.current_fit, bin_img.shape[0])
             
         self.curr_x = fit_x
+        Diag.debug("fit_line")
+        if self.headless:
+            return None
+        
+        out_img = self.debug_image(bin_img, 'fit_img')
         line_pts = np.vstack((self.curr_x, plot_y)).T
         cv2.polylines(out_img, np.int32([line_pts]), isClosed=False, color=(255, 0, 255), thickness=10)
-        
-        print("fit_line")
         return out_img
         
         
@@ -109,11 +325,13 @@ class Lane():
     sw_height: sliding window height
     sw_width: sliding window width
     side of image: 'left' or 'right'
+    pixels: LanePixels of bin_img, built here if not given
     output: lane_pixels ((lane_y, lane_x)y and x locations of lane pixels)
     '''
-    def detect_lane(self, bin_img):
-        out_img = np.dstack((bin_img, bin_img, bin_img))
-        lane_pixels = []
+    def detect_lane(self, bin_img, pixels=None):
+        out_img = None
+        if not self.headless:
+            out_img = self.debug_image(bin_img, 'lane_img')
         base_strip = []
         midpoint = bin_img.shape[1]//2
         
@@ -122,49 +340,47 @@ class Lane():
         base_strip = bin_img[-self.hist_height : , :]
         
         if self.lane_type == 'left':
-            histogram = np.sum(base_strip[:, :midpoint], 0, dtype=np.int)
+            histogram = np.sum(base_strip[:, :midpoint], 0, dtype=int)
         else:
-            histogram = np.sum(base_strip[:, midpoint:], 0, dtype=np.int)
+            histogram = np.sum(base_strip[:, midpoint:], 0, dtype=int)
             offset = midpoint
         
-        nz_pixels = bin_img.nonzero()
-        nz_pixels_y = np.array(nz_pixels[0])
-        nz_pixels_x = np.array(nz_pixels[1])
+        if pixels is None:
+            pixels = LanePixels(bin_img)
         
-        current_x = np.argmax(histogram) + offset
-
+        current_x = int(np.argmax(histogram)) + offset
+        
+        #the windows' per row pixel counts and sums of x go straight into the fit
+        fitter = self.get_fitter(bin_img.shape[0])
 
         for sw in range(bin_img.shape[0]-1, 0, -self.sw_height):
             #points = (x,y)
             win_p1 = (current_x - self.sw_width, sw)
             win_p2 = (current_x + self.sw_width, sw - self.sw_height)
         
-            #draw the line about the centroid
-            cv2.line(out_img, (current_x, win_p2[1]), (current_x, win_p1[1] ), color = (0, 255, 0), thickness=2)
-            #Draw the rectangle around the sliding window
-            cv2.rectangle(out_img, win_p1, win_p2, color=(0, 0, 255))
+            if not self.headless:
+                #draw the line about the centroid
+                cv2.line(out_img, (current_x, win_p2[1]), (current_x, win_p1[1] ), color = (0, 255, 0), thickness=2)
+                #Draw the rectangle around the sliding window
+                cv2.rectangle(out_img, win_p1, win_p2, color=(0, 0, 255))
             #print(sw, sw - sw_height, current_x)
-            #find y pixels that belong to lanes
-            sw_lane_pixels = ((nz_pixels_x >= win_p1[0]) & (nz_pixels_x < win_p2[0]) & (nz_pixels_y < win_p1[1]) & (nz_pixels_y >= win_p2[1])).nonzero()[0]
+            #count and mean x of the lane pixels in the window, without touching the pixels
+            sw_rows, sw_counts, sw_sum_x = pixels.window(win_p2[1], win_p1[1], win_p1[0], win_p2[0])
+            sw_count = np.sum(sw_counts)
 
-
-            #we found the pixels, now add them to a growing list
-            lane_pixels.append(sw_lane_pixels)
+            #we found the pixels, now add them to the fit
+            fitter.add_rows(sw_rows, sw_counts, sw_sum_x)
         
             #if they pixels we found are good enough in number, use this new value to slide window
-            if (len(sw_lane_pixels) >= self.num_white):
-                current_x = np.int(np.mean(nz_pixels_x[sw_lane_pixels]))
-
-
-        #each lane has some n (n<= imageheigt/windowheight lists of non zero pixels. concatenate to get x,y and then model lines)
-        lane_pixels = np.concatenate(lane_pixels)
+            if (sw_count >= self.num_white):
+                current_x = int(np.sum(sw_sum_x)/sw_count)
 
-        lane_x = nz_pixels_x[lane_pixels]
-        lane_y = nz_pixels_y[lane_pixels]
 
-        if (len(lane_y) > 0):
-           fit_img = self.fit_line(bin_img, (lane_y, lane_x), degree=2)
-           out_img = cv2.addWeighted(out_img, 1, fit_img, 1, 0)
+        #each lane has some n (n<= imageheigt/windowheight windows of non zero pixels. they are all in the fitter, now model lines)
+        if (fitter.n > 0):
+           fit_img = self.fit_from_moments(bin_img, fitter)
+           if not self.headless:
+               cv2.addWeighted(out_img, 1, fit_img, 1, 0, dst=out_img)
         return out_img
 
 
@@ -174,61 +390,65 @@ class Lane():
     line_fit: polynomial equation of line
     search_width: window width to search around
     side of image: 'left' or 'right'
+    pixels: LanePixels of bin_img, built here if not given
     output: lane_pixels ((lane_y, lane_x)y and x locations of the putative lane pixels)
     '''
-    def track_lane(self, bin_img):
-        out_img = np.dstack((bin_img, bin_img, bin_img))
+    def track_lane(self, bin_img, pixels=None):
+        out_img = None
         
-        lane_pixels = []    
-
-        nz_pixels = bin_img.nonzero()
-        nz_pixels_y = np.array(nz_pixels[0])
-        nz_pixels_x = np.array(nz_pixels[1])
+        if pixels is None:
+            pixels = LanePixels(bin_img)
         
         if self.best_fit is None:
             track_fit = self.current_fit
         else:
             track_fit = self.best_fit
         
-        # get values of x for corresponding y
-        fit_x = 0
-        for deg,coeff in enumerate(track_fit[::-1]):
-            fit_x += coeff*(nz_pixels_y**deg)
-            lane_pixels = ( (nz_pixels_x > (fit_x - self.search_width) ) & 
-									   (nz_pixels_x < (fit_x + self.search_width) ) )
+        # get values of x for each row. Lane pixels are fit_x - search_width < x < fit_x + search_width,
+        # as integer columns that is [floor(fit_x - search_width) + 1, ceil(fit_x + search_width))
+        plot_y, fit_x = self.eval_fit(track_fit, bin_img.shape[0])
+        band_x = np.clip(fit_x, -self.search_width - 1, bin_img.shape[1] + self.search_width + 1)
+        band_x1 = np.floor(band_x - self.search_width).astype(np.int64) + 1
+        band_x2 = np.ceil(band_x + self.search_width).astype(np.int64)
+        #per row count and sum of x of the lane pixels, from the row index like the sliding windows
+        rows, counts, sum_x = pixels.window(0, bin_img.shape[0], band_x1, band_x2)
 		
         #for Plotting
-        plot_y = np.linspace(0, bin_img.shape[0]-1, bin_img.shape[0])
-        #get values of x for corresponding y
-        fit_x = 0
-        for deg,coeff in enumerate(track_fit[::-1]):
-            fit_x += coeff*(plot_y**deg)
-        line_pts = np.vstack((fit_x, plot_y)).T
-        cv2.polylines(out_img, np.int32([line_pts]), isClosed=False, color=(0, 255, 0), thickness=30)
-        
-        lane_x = nz_pixels_x[lane_pixels]
-        lane_y = nz_pixels_y[lane_pixels]
-        #out_img[lane_y, lane_x, :] = (255, 0, 0)
-        print("track length y", len(np.unique(lane_y)), len(lane_y))
-        if (len(lane_y) > 0 and len(np.unique(lane_y)) > self.min_track_length):
-            fit_img = self.fit_line(bin_img, (lane_y, lane_x), degree=2)
-            out_img = cv2.addWeighted(out_img, 0.5, fit_img, 0.5, 0)
+        if not self.headless:
+            out_img = self.debug_image(bin_img, 'lane_img')
+            line_pts = np.vstack((fit_x, plot_y)).T
+            cv2.polylines(out_img, np.int32([line_pts]), isClosed=False, color=(0, 255, 0), thickness=30)
+        
+        num_pixels = np.sum(counts)
+        #number of rows with lane pixels
+        track_length = np.count_nonzero(counts)
+        Diag.debug("track length y {} {}", track_length, num_pixels)
+        if (num_pixels > 0 and track_length > self.min_track_length):
+            fitter = self.get_fitter(bin_img.shape[0])
+            fitter.add_rows(rows, counts, sum_x)
+            fit_img = self.fit_from_moments(bin_img, fitter)
+            if not self.headless:
+                cv2.addWeighted(out_img, 0.5, fit_img, 0.5, 0, dst=out_img)
         return out_img
         
 
     #function called by Car object whenever a good BT frame achieved
     #This function then decides which (detection or tracking) to call.
-    def find_lane(self, bin_img):
+    #pixels: LanePixels of bin_img, shared between the left and right lanes
+    def find_lane(self, bin_img, pixels=None):
         found_good_lane = False
         out_img = None
         self.current_fit = None
         if bin_img is None:
             self.current_fit = None
         else:
+            t0 = self.timer.start()
             if self.is_tracking:
-                out_img = self.track_lane(bin_img)
+                out_img = self.track_lane(bin_img, pixels)
+                self.timer.stop(self.lane_type + '_track', t0)
             else:
-                out_img = self.detect_lane(bin_img)
+                out_img = self.detect_lane(bin_img, pixels)
+                self.timer.stop(self.lane_type + '_detect', t0)
             if self.current_fit is not None:
                 found_good_lane = self.verify_RoC()
                 
@@ -253,67 +473,58 @@ class Lane():
         self.curr_x = None
         self.curr_roc = None
         self.no_lane_detected_frames += 1
-        print(self.lane_type ,' No lane detected ', self.no_lane_detected_frames)
+        Diag.info("{} No lane detected {}", self.lane_type, self.no_lane_detected_frames)
         if self.no_lane_detected_frames >= self.no_track_frames:
-            print(self.lane_type ,' Resetting')
+            Diag.info("{} Resetting", self.lane_type)
             self.reinitialize()
             
     def lane_detected(self):
         
         self.is_tracking = True
         self.no_lane_detected_frames = 0
-        self.recent_fits.append(self.current_fit)
-        print(self.lane_type ,' detected')
-        print(self.lane_type ,' averaging over ', len(self.recent_fits))
-        self.best_fit = np.mean(self.recent_fits, axis = 0)
+        self.recent_fits.append(self.current_fit, self.current_confidence)
+        Diag.debug("{} detected", self.lane_type)
+        Diag.debug("{} averaging over {}", self.lane_type, len(self.recent_fits))
+        self.best_fit = self.recent_fits.average()
         #print('curr fit', self.current_fit)
         #print('Recent fits', self.recent_fits)
         
     #RoC in pixels
     # check if greater than threshold
     def verify_RoC(self):
-        print("RoC calc")
+        Diag.debug("RoC calc")
         y_eval = self.bin_image_shape[1]
-        pix_roc = ((1 + (2*self.current_fit[0]*y_eval + self.current_fit[1])**2)**1.5) / np.absolute(2*self.current_fit[0])
-        print(self.lane_type ,' roc', pix_roc)
+        pix_roc = radius_of_curvature(self.current_fit, y_eval)
+        Diag.debug("{} roc {}", self.lane_type, pix_roc)
         if pix_roc <= self.min_RoC:
-            print(self.lane_type, "RoC too small")
+            Diag.info("{} RoC too small", self.lane_type)
             return False
         return True
         
     #RoC in meters
     def calc_RoC(self):
         #calculate with best fit
-        # Fit new polynomials to x,y in world space
-        pts = self.calc_lane_points()
-        pts_x = pts[:, 0]*self.scale_X
-        pts_y = pts[:, 1]*self.scale_Y
-        print(len(pts_x))
-        self.fit_m = np.polyfit(pts_y, pts_x, 2)
+        #the pixel to meter scaling is linear, so the world space fit is the pixel fit rescaled. No refit needed
+        self.fit_m = self.world_scale*self.best_fit
 
         y_eval = self.bin_image_shape[1]*self.scale_Y
         # Calculate the new radius of curvature
-        self.radius_of_curvature = ((1 + (2*self.fit_m[0]*y_eval + self.fit_m[1])**2)**1.5) / np.absolute(2*self.fit_m[0])
+        self.radius_of_curvature = radius_of_curvature(self.fit_m, y_eval)
         # Now our radius of curvature is in meters
     
     #position of base of the lane in meters	
     def calc_base_position(self):
         #calculate with best fit
-        y_eval = self.bin_image_shape[1]
-        # Calculate the new radius of curvature
-        self.base_pos = 0
-        for deg,coeff in enumerate(self.best_fit[::-1]):
-            self.base_pos += coeff*(y_eval**deg)
-        # Now our radius of curvature is in meters
-        print("base", self.base_pos)
+        self.base_pos = self.base_basis.dot(self.best_fit)
+        Diag.debug("base {}", self.base_pos)
             
     #calc lane points in pixels for plotting
-    #vertical array of (x,y)
+    #vertical array of (x,y). Memoized until best_fit changes, so the array is read only
     def calc_lane_points(self):
-        plot_y = np.linspace(0, self.bin_image_shape[1]-1, self.bin_image_shape[1])
-        # Generate x values for each y for plotting
-        fit_x = 0
-        for deg,coeff in enumerate(self.best_fit[::-1]):
-            fit_x += coeff*(plot_y**deg)
-        line_pts = np.vstack((fit_x, plot_y)).T
-        return line_pts
+        if self.lane_points is None or not np.array_equal(self.lane_points_fit, self.best_fit):
+            # Generate x values for each y for plotting
+            plot_y, fit_x = self.eval_fit(self.best_fit, self.bin_image_shape[1])
+            self.lane_points = np.vstack((fit_x, plot_y)).T
+            self.lane_points.flags.writeable = False
+            self.lane_points_fit = np.copy(self.best_fit)
+        return self.lane_points
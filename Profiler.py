@@ -0,0 +1,108 @@
+'''
+Class to record per stage latency of the lane pipeline.
+Samples are kept in memory (one array per stage) and summarised at the end
+of a run with percentiles. When disabled start/stop return straight away,
+so the calls can stay in the pipeline.
+
+usage:
+    t0 = timer.start()
+    ...stage...
+    timer.stop('undistort', t0)
+'''
+from array import array
+import json
+import time
+import numpy as np
+
+percentiles = [50, 95, 99]
+
+class StageTimer():
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        #stage name -> latency samples in seconds
+        self.latencies = {}
+        #name -> per frame values that are not times (eg. threshold steps)
+        self.counts = {}
+
+    def start(self):
+        if not self.enabled:
+            return 0
+        return time.perf_counter()
+
+    def stop(self, stage, t0):
+        if not self.enabled:
+            return
+        self.record(stage, time.perf_counter() - t0)
+
+    def record(self, stage, dt):
+        if not self.enabled:
+            return
+        if stage not in self.latencies:
+            self.latencies[stage] = array('d')
+        self.latencies[stage].append(dt)
+
+    def count(self, name, value):
+        if not self.enabled:
+            return
+        if name not in self.counts:
+            self.counts[name] = array('d')
+        self.counts[name].append(value)
+
+    def clear(self):
+        self.latencies.clear()
+        self.counts.clear()
+
+    #list of dicts, one per stage. Latencies are reported in milliseconds
+    def summary(self):
+        rows = []
+        for samples, unit, scale in [(self.latencies, 'ms', 1000.0), (self.counts, 'count', 1.0)]:
+            for name, values in samples.items():
+                values = np.frombuffer(values, dtype=np.float64)*scale
+                row = {'stage': name, 'unit': unit, 'n': len(values),
+                       'mean': float(np.mean(values)), 'max': float(np.max(values))}
+                for p, v in zip(percentiles, np.percentile(values, percentiles)):
+                    row['p{}'.format(p)] = float(v)
+                rows.append(row)
+        return rows
+
+    def print_summary(self):
+        for row in self.summary():
+            print("{:<16} {:>6} {:>5} p50 {:.3f} p95 {:.3f} p99 {:.3f} max {:.3f}".format(
+                row['stage'], row['n'], row['unit'], row['p50'], row['p95'], row['p99'], row['max']))
+
+    def export_csv(self, file_name):
+        columns = ['stage', 'unit', 'n', 'mean'] + ['p{}'.format(p) for p in percentiles] + ['max']
+        with open(file_name, 'w') as f:
+            f.write(','.join(columns) + '\n')
+            for row in self.summary():
+                f.write(','.join(str(row[c]) for c in columns) + '\n')
+
+    def export_json(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+'''
+Class to hold the time budget of one frame (real time mode).
+start() at the beginning of the frame, stages then check expired().
+A Deadline without a budget never expires.
+'''
+class Deadline():
+
+    def __init__(self, budget_ms=None):
+        self.budget = None if budget_ms is None else budget_ms/1000.0
+        #perf_counter time the current frame is due
+        self.due = None
+
+    def start(self):
+        if self.budget is not None:
+            self.due = time.perf_counter() + self.budget
+
+    def expired(self):
+        return self.due is not None and time.perf_counter() > self.due
+
+    #how far past the deadline we are, 0 if not
+    def overrun_ms(self):
+        if self.due is None:
+            return 0.0
+        return max(time.perf_counter() - self.due, 0.0)*1000
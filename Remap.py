@@ -0,0 +1,124 @@
+'''
+Class to hold precomputed remap tables bound to a camera calibration.
+cv2.undistort rebuilds the distortion map on every call. We build the
+initUndistortRectifyMap tables once per frame size and keep them as
+fixed-point maps (CV_16SC2 + interpolation table), which is what cv2.remap
+is fastest with.
+'''
+import numpy as np
+import cv2
+
+class UndistortRemap():
+
+    def __init__(self, camera_calibration):
+        self.mtx = camera_calibration['mtx']
+        self.dist = camera_calibration['dist']
+
+        #full frame maps keyed by frame size (X, Y)
+        self.maps = {}
+        #ROI maps keyed by (X, Y, x_offset, y_begin)
+        self.roi_maps = {}
+
+    #float maps for the full frame. Used to build the fixed point maps
+    #and by anyone who needs to compose other geometry on top of them
+    def get_float_maps(self, frame_size):
+        map_x, map_y = cv2.initUndistortRectifyMap(self.mtx, self.dist, None, self.mtx, frame_size, cv2.CV_32FC1)
+        return map_x, map_y
+
+    #fixed point maps for the full frame, built once per frame size
+    def get_maps(self, frame_size):
+        if frame_size not in self.maps:
+            self.maps[frame_size] = cv2.initUndistortRectifyMap(self.mtx, self.dist, None, self.mtx, frame_size, cv2.CV_16SC2)
+        return self.maps[frame_size]
+
+    #fixed point maps for the ROI rows/cols only (same crop as utilities.get_ROI)
+    #the map values are absolute source coordinates, so we can slice the full maps
+    def get_roi_maps(self, frame_size, x_offset, y_begin):
+        key = (frame_size[0], frame_size[1], x_offset, y_begin)
+        if key not in self.roi_maps:
+            map1, map2 = self.get_maps(frame_size)
+            x1, y1 = x_offset, y_begin
+            x2, y2 = frame_size[0]-x1, frame_size[1]
+            self.roi_maps[key] = (np.ascontiguousarray(map1[y1:y2, x1:x2]),
+                                  np.ascontiguousarray(map2[y1:y2, x1:x2]))
+        return self.roi_maps[key]
+
+    #drop in replacement for utilities.undistort
+    #dst: optional output array (same shape as img) to write into
+    def undistort(self, img, dst=None):
+        map1, map2 = self.get_maps((img.shape[1], img.shape[0]))
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+    #undistort only the ROI. Equivalent to get_ROI(undistort(img), x_offset, y_begin)
+    def undistort_roi(self, img, x_offset, y_begin, dst=None):
+        map1, map2 = self.get_roi_maps((img.shape[1], img.shape[0]), x_offset, y_begin)
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+    #undistort everything but the ROI into dst (same shape as img), leaving the ROI of dst as it is.
+    #With undistort_roi written into the ROI of dst, dst is undistort(img)
+    def undistort_outside_roi(self, img, x_offset, y_begin, dst):
+        map1, map2 = self.get_maps((img.shape[1], img.shape[0]))
+        x2 = img.shape[1] - x_offset
+        #rows above the ROI, then the columns left and right of it
+        for rows, cols in [(slice(0, y_begin), slice(None)),
+                           (slice(y_begin, None), slice(0, x_offset)),
+                           (slice(y_begin, None), slice(x2, None))]:
+            cv2.remap(img, map1[rows, cols], map2[rows, cols], cv2.INTER_LINEAR, dst=dst[rows, cols])
+        return dst
+
+'''
+Class to hold a single remap that goes straight from the raw (distorted)
+frame to the bird's eye view.
+It composes the camera distortion, the ROI offset and the perspective warp
+(warp_Minv) so the bird's eye image needs one interpolation pass instead of
+undistort -> crop -> warpPerspective.
+'''
+class BirdsEyeRemap():
+
+    def __init__(self, undistort_remap, Minv, x_offset, y_begin, bin_image_shape):
+        self.undistort_remap = undistort_remap
+        self.warp_Minv = Minv
+        self.x_offset = x_offset
+        self.y_begin = y_begin
+        #tuple (X, Y)
+        self.bin_image_shape = bin_image_shape
+
+        #fused maps keyed by raw frame size (X, Y)
+        self.maps = {}
+
+    #compose the maps once per frame size
+    def get_maps(self, frame_size):
+        if frame_size in self.maps:
+            return self.maps[frame_size]
+
+        out_x, out_y = self.bin_image_shape
+        roi_x = frame_size[0] - 2*self.x_offset
+        roi_y = frame_size[1] - self.y_begin
+
+        #bird's eye pixel grid -> ROI coordinates (what warpPerspective would sample)
+        grid_x, grid_y = np.meshgrid(np.arange(out_x, dtype=np.float32), np.arange(out_y, dtype=np.float32))
+        grid = np.dstack((grid_x, grid_y)).reshape(-1, 1, 2)
+        roi_pts = cv2.perspectiveTransform(grid, self.warp_Minv).reshape(out_y, out_x, 2)
+
+        #anything sampled from outside the ROI was zero filled by warpPerspective
+        outside = ((roi_pts[:, :, 0] < -0.5) | (roi_pts[:, :, 0] > roi_x - 0.5) |
+                   (roi_pts[:, :, 1] < -0.5) | (roi_pts[:, :, 1] > roi_y - 0.5))
+
+        #ROI coordinates -> undistorted frame coordinates -> raw frame coordinates
+        undist_x = np.ascontiguousarray(roi_pts[:, :, 0] + self.x_offset, dtype=np.float32)
+        undist_y = np.ascontiguousarray(roi_pts[:, :, 1] + self.y_begin, dtype=np.float32)
+        map_x, map_y = self.undistort_remap.get_float_maps(frame_size)
+        raw_x = cv2.remap(map_x, undist_x, undist_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        raw_y = cv2.remap(map_y, undist_x, undist_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+        #push outside pixels well clear of the frame so remap fills them with 0
+        raw_x[outside] = -100
+        raw_y[outside] = -100
+
+        self.maps[frame_size] = cv2.convertMaps(raw_x, raw_y, cv2.CV_16SC2)
+        return self.maps[frame_size]
+
+    #raw frame -> bird's eye view in one pass
+    def remap(self, img, dst=None):
+        map1, map2 = self.get_maps((img.shape[1], img.shape[0]))
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=dst, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
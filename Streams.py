@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Multi-stream lane tracking: N independent Cars (one per camera) in one process.
+Every stream has its own Car with its own copy of lane_config/bt_config
+(binary_threshold and the lanes keep per stream state in them). The undistort
+and bird's eye remap tables are built once and shared, read only, by all the Cars.
+Frames from all the streams go to one shared thread pool (OpenCV releases the GIL).
+A stream's frames have to go through its Car in order, so a stream has at most one
+frame in flight and the next one is scheduled when it is done. Different streams
+run in parallel, and streams take turns on the workers.
+
+usage:
+    engine = Streams.StreamEngine(calibration, M, Minv, num_streams=4)
+    future = engine.submit(stream_id, frame)    #future.result() is (frame #, annotated frame or None)
+    records = engine.telemetry(stream_id)
+    engine.close()
+
+    python Streams.py <video> [<video> ...]     #one stream per video, telemetry out
+'''
+import os, sys
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import cv2
+import imageio
+
+import ALF
+import Remap
+import Telemetry
+import utilities as laneUtils
+
+'''
+Class to hold one stream: its Car, the frames waiting for it and its telemetry
+'''
+class Stream():
+
+    def __init__(self, stream_id, Car_obj):
+        self.stream_id = stream_id
+        self.car = Car_obj
+        #(frame, future) waiting to be processed, in order
+        self.pending = deque()
+        #a frame of this stream is on the pool
+        self.running = False
+        self.frame_count = 0
+        #lane geometry per frame, kept in memory
+        self.telemetry = Telemetry.TelemetryWriter(None)
+
+class StreamEngine():
+
+    '''
+    calibration, M, Minv: shared by all streams
+    num_streams: number of streams (stream ids are 0..num_streams-1)
+    num_workers: threads in the shared pool, one per stream if None
+    lane_overrides/bt_overrides: optional list (one dict per stream) of config values that differ for that stream
+    max_pending: frames a stream can have waiting. submit blocks when the stream is full
+    '''
+    def __init__(self, calibration, M, Minv, num_streams, num_workers=None,
+                 lane_overrides=None, bt_overrides=None, max_pending=8):
+        if num_workers is None:
+            num_workers = num_streams
+        self.max_pending = max_pending
+        self.lock = threading.Condition()
+
+        #read only maps, shared by every Car with the same ROI
+        self.undistort_remap = Remap.UndistortRemap(calibration)
+        birds_eye_remaps = {}
+        self.streams = []
+        for stream_id in range(num_streams):
+            lane_cfg = lane_overrides[stream_id] if lane_overrides is not None else None
+            bt_cfg = bt_overrides[stream_id] if bt_overrides is not None else None
+            Car_obj = ALF.make_car(calibration, M, Minv, lane_cfg, bt_cfg, undistort_remap=self.undistort_remap)
+            key = (Car_obj.ROI_x1, Car_obj.ROI_y1, Car_obj.bin_image_shape)
+            if key not in birds_eye_remaps:
+                birds_eye_remaps[key] = Car_obj.birds_eye_remap
+            Car_obj.birds_eye_remap = birds_eye_remaps[key]
+            self.streams.append(Stream(stream_id, Car_obj))
+        #frame sizes the shared maps have been built for
+        self.frame_sizes = set()
+
+        #one frame per worker, don't let OpenCV oversubscribe the cores as well
+        self.cv_threads = cv2.getNumThreads()
+        if num_workers > 1:
+            cv2.setNumThreads(1)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    #build the shared maps for a frame size before any worker reads them
+    def prepare_maps(self, frame_size):
+        self.undistort_remap.get_maps(frame_size)
+        for stream in self.streams:
+            Car_obj = stream.car
+            self.undistort_remap.get_roi_maps(frame_size, Car_obj.ROI_x1, Car_obj.ROI_y1)
+            if Car_obj.fused_remap:
+                Car_obj.birds_eye_remap.get_maps(frame_size)
+        self.frame_sizes.add(frame_size)
+
+    #queue a frame of a stream. Returns a Future of (frame #, annotated frame or None if headless)
+    #frame must not be changed until the future is done. The annotated frame is a copy the caller owns
+    def submit(self, stream_id, frame):
+        future = Future()
+        stream = self.streams[stream_id]
+        with self.lock:
+            frame_size = (frame.shape[1], frame.shape[0])
+            if frame_size not in self.frame_sizes:
+                self.prepare_maps(frame_size)
+            while len(stream.pending) >= self.max_pending:
+                self.lock.wait()
+            stream.pending.append((frame, future))
+            if not stream.running:
+                stream.running = True
+                self.pool.submit(self._run, stream)
+        return future
+
+    #process the next frame of a stream, then put the stream back on the pool if it has more
+    def _run(self, stream):
+        with self.lock:
+            frame, future = stream.pending.popleft()
+            self.lock.notify_all()
+        if future.set_running_or_notify_cancel():
+            try:
+                i = stream.frame_count
+                Car_obj = stream.car
+                out_frame = None
+                if Car_obj.headless:
+                    Car_obj = ALF._process_headless(frame, Car_obj)
+                else:
+                    Car_obj, out_frame = ALF._process(frame, Car_obj)
+                    #the Car's frame buffer is reused by its next frame
+                    out_frame = out_frame.copy()
+                stream.telemetry.append(i, Car_obj)
+                stream.frame_count += 1
+                future.set_result((i, out_frame))
+            except Exception as e:
+                future.set_exception(e)
+        with self.lock:
+            if stream.pending:
+                self.pool.submit(self._run, stream)
+            else:
+                stream.running = False
+                self.lock.notify_all()
+
+    def car(self, stream_id):
+        return self.streams[stream_id].car
+
+    #lane geometry of every frame of a stream so far (Telemetry.telemetry_dtype records)
+    def telemetry(self, stream_id):
+        return self.streams[stream_id].telemetry.records()
+
+    #wait for all queued frames, then stop the workers
+    def close(self):
+        with self.lock:
+            while any(stream.running for stream in self.streams):
+                self.lock.wait()
+        self.pool.shutdown()
+        cv2.setNumThreads(self.cv_threads)
+
+#Decode a video and feed it to a stream. Runs on its own thread
+def _feed_stream(engine, stream_id, video_name, futures):
+    for image in imageio.get_reader(video_name):
+        futures.append(engine.submit(stream_id, cv2.cvtColor(image, cv2.COLOR_RGB2BGR)))
+
+def main():
+    video_names = sys.argv[1:]
+    calibration = ALF.get_calibration()
+    M, Minv = laneUtils.get_warp_unwarp_matrices(ALF.warp_config)
+    #telemetry only, no rendering
+    headless = [{'headless': True} for _ in video_names]
+    engine = StreamEngine(calibration, M, Minv, len(video_names), lane_overrides=headless)
+
+    futures = [[] for _ in video_names]
+    feeders = [threading.Thread(target=_feed_stream, args=(engine, i, name, futures[i]))
+               for i, name in enumerate(video_names)]
+    start = time.time()
+    for feeder in feeders:
+        feeder.start()
+    for feeder in feeders:
+        feeder.join()
+    for stream_futures in futures:
+        for future in stream_futures:
+            future.result()
+    end = time.time()
+    engine.close()
+
+    total_frames = 0
+    for i, name in enumerate(video_names):
+        writer = engine.streams[i].telemetry
+        writer.file_name = '{}_stream{}_telemetry.npz'.format(os.path.splitext(os.path.basename(name))[0], i)
+        writer.close()
+        total_frames += writer.rows
+        print(name, writer.rows, "frames ->", writer.file_name)
+    print("{} streams, {} frames, {:.2f} s, {:.2f} FPS aggregate".format(len(video_names), total_frames, end - start, total_frames/(end - start)))
+
+if __name__ == "__main__":
+    main()
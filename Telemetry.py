@@ -0,0 +1,72 @@
+'''
+Class to record per frame lane geometry instead of an annotated video.
+Rows are kept in preallocated structured array chunks and written as one
+compressed .npz with a column per field when the writer is closed.
+Values that are not available for a frame (not tracking yet) are NaN.
+'''
+import numpy as np
+
+telemetry_dtype = np.dtype([('frame', np.int32),
+                            ('left_tracking', np.bool_),
+                            ('right_tracking', np.bool_),
+                            ('RoC', np.float64),
+                            ('dist_from_center', np.float64),
+                            ('left_fit', np.float64, 3),
+                            ('right_fit', np.float64, 3)])
+
+def _value(v):
+    return np.nan if v is None else v
+
+#write the state of the car after frame # i into row (a telemetry_dtype record)
+def fill_record(row, i, Car_obj):
+    row['frame'] = i
+    row['left_tracking'] = Car_obj.is_left_lane_tracking()
+    row['right_tracking'] = Car_obj.is_right_lane_tracking()
+    both_tracking = row['left_tracking'] and row['right_tracking']
+    row['RoC'] = Car_obj.RoC if both_tracking and Car_obj.RoC is not None else np.nan
+    row['dist_from_center'] = Car_obj.dist_from_center if both_tracking and Car_obj.dist_from_center is not None else np.nan
+    row['left_fit'] = _value(Car_obj.left_Line.best_fit)
+    row['right_fit'] = _value(Car_obj.right_Line.best_fit)
+    return row
+
+#the state of the car after frame # i as a new telemetry_dtype record
+def make_record(i, Car_obj):
+    return fill_record(np.zeros((), dtype=telemetry_dtype), i, Car_obj)
+
+class TelemetryWriter():
+
+    def __init__(self, file_name, fps=None, chunk_size=1024):
+        self.file_name = file_name
+        self.fps = fps
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.rows = 0
+
+    #record the state of the car after frame # i
+    def append(self, i, Car_obj):
+        if self.rows % self.chunk_size == 0:
+            self.chunks.append(np.zeros(self.chunk_size, dtype=telemetry_dtype))
+        fill_record(self.chunks[-1][self.rows % self.chunk_size], i, Car_obj)
+        self.rows += 1
+
+    #all rows recorded so far as one structured array
+    def records(self):
+        if not self.chunks:
+            return np.zeros(0, dtype=telemetry_dtype)
+        return np.concatenate(self.chunks)[:self.rows]
+
+    def close(self):
+        records = self.records()
+        columns = {name: records[name] for name in telemetry_dtype.names}
+        columns['fps'] = np.nan if self.fps is None else self.fps
+        np.savez_compressed(self.file_name, **columns)
+        return self.file_name
+
+#read a telemetry file back as a structured array (and the fps it was recorded at)
+def read_telemetry(file_name):
+    with np.load(file_name) as data:
+        records = np.zeros(len(data['frame']), dtype=telemetry_dtype)
+        for name in telemetry_dtype.names:
+            records[name] = data[name]
+        fps = float(data['fps'])
+    return records, fps
@@ -46,13 +46,19 @@ def draw_polygon(img, p1, p2, p3, p4):
     out = cv2.polylines(img, [pts], True, (0,255,255))
     return out
 
+#Polygon of the strip half_width (in x) on either side of a line of points (N x 2, x and y)
+def line_strip(points, half_width):
+    offset = np.array([half_width, 0])
+    return np.vstack((points - offset, np.flipud(points + offset)))
+
 #drawPolygon(img, (380, 10), (505, 10), (875, 235), (45, 235) )
 #drawPolygon(img, (350, 30), (540, 30), (875, 235), (45, 235) )
 
 #Warp an image to an output size by applying M
 #out_size is a tuple (640, 240)
-def warp_image(img, M, out_size):
-    return cv2.warpPerspective(img, M, out_size, flags=cv2.INTER_LINEAR+cv2.WARP_FILL_OUTLIERS)
+#dst: optional output array to write into
+def warp_image(img, M, out_size, dst=None):
+    return cv2.warpPerspective(img, M, out_size, dst=dst, flags=cv2.INTER_LINEAR+cv2.WARP_FILL_OUTLIERS)
 
 def get_warp_unwarp_matrices(w_cfg):
     src_pts = np.array([w_cfg['P1'], w_cfg['P2'], w_cfg['P3'], w_cfg['P4']], dtype=np.float32)